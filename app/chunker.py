@@ -0,0 +1,83 @@
+import re
+import threading
+
+STAGE = re.compile(r'^\s*(\w+)\s*:\s*\{(.*)\}\s*$')
+ATOM = re.compile(r'<([^<>]*)>')
+
+# Chunks tagged sentences like nltk.RegexpParser with a cascade of chunk
+# rules, one "LABEL: {<tag pattern>}" rule per grammar line, but compiled
+# once. Every tag and chunk label is mapped to one character, so each rule
+# is a regex over a short string with one character per token, and every
+# <tag pattern> becomes a character class of the labels it matches.
+class ChunkGrammar(object):
+
+  def __init__(self, grammar, root='S'):
+    self.root = root
+    self.stages = []
+    for line in grammar.strip().split('\n'):
+      if line.strip():
+        stage = STAGE.match(line)
+        if not stage:
+          raise ValueError('not a chunk rule: %r' % line)
+        self.stages.append((stage.group(1), re.sub(r'\s', '', stage.group(2))))
+    self.symbols = {}
+    self.compiled = []
+    self.lock = threading.Lock()
+    self.intern([label for label, pattern in self.stages])
+
+  # gives new labels a character and recompiles the rules for them
+  def intern(self, labels):
+    new = [label for label in set(labels) if label not in self.symbols]
+    if not new:
+      return self.compiled
+    with self.lock:
+      symbols = dict(self.symbols)
+      for label in new:
+        symbols.setdefault(label, chr(0x100 + len(symbols)))
+      compiled = [(label, re.compile(ATOM.sub(lambda atom: self.atom(atom.group(1), symbols), pattern)))
+        for label, pattern in self.stages]
+      self.symbols, self.compiled = symbols, compiled
+    return compiled
+
+  # character class of every known label that the tag pattern matches as a
+  # whole; '.' does not match the characters that delimit tags in nltk
+  def atom(self, pattern, symbols):
+    pattern = re.compile(pattern.replace('.', '[^{}<>]'))
+    matches = [symbol for label, symbol in sorted(symbols.items()) if pattern.fullmatch(label)]
+    return '[%s]' % ''.join(matches) if matches else r'[^\s\S]'
+
+  # the nodes of the chunked sentence: (word, tag) leaves and [label, nodes]
+  # chunks, with the labels of every chunk found
+  def chunk(self, sentence):
+    nodes = list(sentence)
+    labels = [tag for word, tag in sentence]
+    compiled = self.intern(labels)
+    symbols = self.symbols
+    found = set()
+    for label, regex in compiled:
+      string = ''.join(symbols[node_label] for node_label in labels)
+      chunked_nodes, chunked_labels, last = [], [], 0
+      for match in regex.finditer(string):
+        start, end = match.span()
+        if start == end:
+          continue
+        chunked_nodes += nodes[last:start] + [[label, nodes[start:end]]]
+        chunked_labels += labels[last:start] + [label]
+        last = end
+      if last:
+        found.add(label)
+        nodes, labels = chunked_nodes + nodes[last:], chunked_labels + labels[last:]
+    return nodes, found
+
+  # labels of the root and every chunk, as Tree.subtrees() would give them
+  def labels(self, sentence):
+    return self.chunk(sentence)[1] | set([self.root])
+
+  def parse(self, sentence):
+    from nltk.tree import Tree
+    return Tree(self.root, [ChunkGrammar.tree(node, Tree) for node in self.chunk(sentence)[0]])
+
+  def tree(node, Tree):
+    if isinstance(node, list):
+      return Tree(node[0], [ChunkGrammar.tree(child, Tree) for child in node[1]])
+    return node
@@ -0,0 +1,122 @@
+import re
+
+ATOM = re.compile(r'\[[^\]]*\]|\\.|.', re.DOTALL)
+
+# Matches the role, means and ends indicator patterns of a story in a single
+# scan. The patterns are merged into one regex shaped like a prefix tree, with
+# an empty group where each pattern ends, so one match reports every
+# indicator that starts at that position.
+class IndicatorEngine(object):
+
+  def __init__(self, indicators):
+    self.kinds = list(indicators)
+    self.indicators = [(kind, indicator) for kind in self.kinds for indicator in indicators[kind]]
+
+    # patterns as written, searched in the lower-cased title
+    self.matcher = IndicatorMatcher([indicator.lower() for kind, indicator in self.indicators])
+    self.phrases = [indicator.replace('^', '').replace('[, ]', '').strip() for kind, indicator in self.indicators]
+
+    # patterns without their separator, searched in a single chunk
+    self.chunk_matchers, self.chunk_phrases = {}, {}
+    for kind in self.kinds:
+      self.chunk_matchers[kind] = IndicatorMatcher([indicator.lower().replace('[, ]', '') for indicator in indicators[kind]])
+      self.chunk_phrases[kind] = [indicator.replace('^', '').replace('[, ]', '') for indicator in indicators[kind]]
+
+    self.literals = dict((kind, [(indicator.lower().strip(), indicator) for indicator in indicators[kind]]) for kind in self.kinds)
+
+  # spans of every indicator hit in the title, per kind. Hits of one indicator
+  # do not overlap, as with re.finditer; hits of different indicators may.
+  def spans(self, title):
+    spans = dict((kind, []) for kind in self.kinds)
+    if title:
+      last_end = {}
+      for index, start, end in sorted(self.matcher.matches(title.lower())):
+        if start >= last_end.get(index, 0):
+          spans[self.indicators[index][0]].append((start, end))
+          last_end[index] = end
+    return spans
+
+  # longest indicator phrase per kind, as (found, phrase). Patterns are
+  # searched in the haystack, a cleaned up version of the text, but the
+  # phrase itself must also occur in the text.
+  def detect(self, text, haystack):
+    detected = dict((kind, (False, '')) for kind in self.kinds)
+    if text:
+      lowered = text.lower()
+      for index in sorted(set(index for index, start, end in self.matcher.matches(haystack.lower()))):
+        kind, phrase = self.indicators[index][0], self.phrases[index]
+        if phrase.lower() in lowered:
+          longest = detected[kind][1]
+          detected[kind] = (True, phrase if len(phrase) > len(longest) else longest)
+    return detected
+
+  # longest indicator phrase of a kind in a role, means or ends chunk
+  def extract(self, chunk, kind):
+    if not chunk:
+      return chunk
+    found = sorted(set(index for index, start, end in self.chunk_matchers[kind].matches(chunk.lower())))
+    phrases = [self.chunk_phrases[kind][index] for index in found]
+    return max(phrases, key=len) if phrases else None
+
+  # indicators of a kind whose literal text occurs in the text
+  def contained(self, text, kind):
+    lowered = text.lower()
+    return [indicator for literal, indicator in self.literals[kind] if literal in lowered]
+
+# Prefix tree regex over patterns made of single characters, escapes and
+# character classes, optionally anchored with ^. Sibling branches must not
+# overlap, so a match follows the one path that every matching pattern is on.
+class IndicatorMatcher(object):
+
+  def __init__(self, patterns):
+    self.anchored = IndicatorMatcher.compile([(index, pattern[1:]) for index, pattern in enumerate(patterns) if pattern.startswith('^')])
+    self.unanchored = IndicatorMatcher.compile([(index, pattern) for index, pattern in enumerate(patterns) if not pattern.startswith('^')])
+
+  # (regex, pattern index of every group) or None without patterns
+  def compile(patterns):
+    if not patterns:
+      return None
+    tree = {}
+    for index, pattern in patterns:
+      node = tree
+      for atom in ATOM.findall(pattern):
+        node = node.setdefault(atom, {})
+      node.setdefault(None, []).append(index)
+    groups = []
+    return re.compile(IndicatorMatcher.branch(tree, groups)), groups
+
+  def branch(node, groups):
+    expression = ''
+    for index in node.get(None, []):
+      groups.append(index)
+      expression += '()'
+    children = [atom for atom in node if atom is not None]
+    if len(children) > 1 and any(atom.startswith('[') for atom in children):
+      raise ValueError('indicator patterns overlap at %s' % children)
+    if len(children) == 1 and None not in node:
+      expression += children[0] + IndicatorMatcher.branch(node[children[0]], groups)
+    elif children:
+      alternatives = '(?:%s)' % '|'.join(atom + IndicatorMatcher.branch(node[atom], groups) for atom in children)
+      expression += alternatives + '?' if None in node else alternatives
+    return expression
+
+  def hits(match, groups):
+    hits = []
+    for group, end in enumerate(match.regs[1:]):
+      if end[0] >= 0: hits.append((groups[group], match.start(), end[0]))
+    return hits
+
+  # (pattern index, start, end) of every pattern hit, overlapping ones included
+  def matches(self, text):
+    hits = []
+    if self.anchored:
+      regex, groups = self.anchored
+      match = regex.match(text)
+      if match: hits += IndicatorMatcher.hits(match, groups)
+    if self.unanchored:
+      regex, groups = self.unanchored
+      match = regex.search(text)
+      while match:
+        hits += IndicatorMatcher.hits(match, groups)
+        match = regex.search(text, match.start() + 1)
+    return hits
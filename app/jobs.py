@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import time
+import traceback
+import uuid
+
+# A unit of background work. The function it runs receives the job, so it
+# can report how far along it is through progress(). What it returns is the
+# result of the job, and must serialize to JSON. The store, if any, is
+# given the job whenever its state changes.
+class Job(object):
+
+  def __init__(self, name, func, store=None):
+    self.id = uuid.uuid4().hex
+    self.name = name
+    self.func = func
+    self.status = 'queued'
+    self.stage = None
+    self.done = 0
+    self.total = None
+    self.result = None
+    self.error = None
+    self.created_at = datetime.now()
+    self.finished_at = None
+    self.store = store
+
+  @property
+  def finished(self):
+    return self.status in ('done', 'failed')
+
+  def progress(self, stage, done, total=None):
+    self.stage = stage
+    self.done = done
+    self.total = total
+    self.changed()
+
+  # a failing store does not fail the job
+  def changed(self):
+    if self.store is None:
+      return
+    try:
+      self.store(self)
+    except Exception:
+      traceback.print_exc()
+
+  def run(self):
+    self.status = 'running'
+    self.changed()
+    try:
+      self.result = self.func(self)
+      self.status = 'done'
+    except Exception as error:
+      self.error = '%s: %s' % (type(error).__name__, error)
+      self.status = 'failed'
+      traceback.print_exc()
+    finally:
+      self.finished_at = datetime.now()
+      self.changed()
+
+  def serialize(self):
+    return {'id': self.id, 'name': self.name, 'status': self.status, 'stage': self.stage,
+      'done': self.done, 'total': self.total, 'result': self.result, 'error': self.error,
+      'created_at': self.created_at.isoformat(),
+      'finished_at': self.finished_at.isoformat() if self.finished_at else None}
+
+# Runs jobs on a small pool of worker threads inside the web process, so
+# requests return at once with a job id that can be polled. Every job runs
+# within context(), e.g. the Flask app context, and only the most recent
+# finished jobs are remembered. With a store, e.g. a database table, jobs
+# can also be looked up from other processes and after a restart.
+class JobQueue(object):
+
+  def __init__(self, workers=1, context=None, keep=1000, store=None):
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+    self.context = context
+    self.keep = keep
+    self.store = store
+    self.jobs = OrderedDict()
+    self.lock = threading.Lock()
+
+  def submit(self, name, func):
+    job = Job(name, func, self.store)
+    job.changed()
+    with self.lock:
+      self.jobs[job.id] = job
+      self._forget()
+    self.executor.submit(self._run, job)
+    return job
+
+  def _run(self, job):
+    if self.context is None:
+      return job.run()
+    with self.context():
+      job.run()
+
+  def _forget(self):
+    finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+    for job_id in finished[:max(0, len(self.jobs) - self.keep)]:
+      del self.jobs[job_id]
+
+  def get(self, job_id):
+    return self.jobs.get(job_id)
+
+  def close(self):
+    self.executor.shutdown()
+
+# Calls lookup until it returns something, for rows that the request which
+# created them may not have committed yet. Raises LookupError on timeout.
+def wait_for(lookup, timeout=10, interval=0.25):
+  deadline = time.time() + timeout
+  while True:
+    found = lookup()
+    if found is not None:
+      return found
+    if time.time() >= deadline:
+      raise LookupError('not found after %s seconds' % timeout)
+    time.sleep(interval)
@@ -0,0 +1,88 @@
+import mmap
+import os
+
+POS_LIST = ['n', 'v', 'a', 'r']
+# WordNet's morphy rules, as applied by nltk's wordnet.synsets()
+MORPHOLOGICAL_SUBSTITUTIONS = {
+  'n': [('s', ''), ('ses', 's'), ('ves', 'f'), ('xes', 'x'), ('zes', 'z'), ('ches', 'ch'), ('shes', 'sh'), ('men', 'man'), ('ies', 'y')],
+  'v': [('s', ''), ('ies', 'y'), ('es', 'e'), ('es', ''), ('ed', 'e'), ('ed', ''), ('ing', 'e'), ('ing', '')],
+  'a': [('er', ''), ('est', ''), ('er', 'e'), ('est', 'e')],
+  'r': []}
+
+# The WordNet lemmas and morphy exceptions in a sorted, memory-mapped file,
+# one "word<TAB>parts of speech<TAB>exceptions" line per word, looked up by
+# binary search. Tells whether wordnet.synsets(word) would find anything,
+# without loading the WordNet corpus.
+class Lexicon(object):
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as lexicon_file:
+      self.data = mmap.mmap(lexicon_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  # the lexicon at path, or None when it has not been built
+  def open(path):
+    if path and os.path.exists(path) and os.path.getsize(path):
+      return Lexicon(path)
+    return None
+
+  # (parts of speech, {part of speech: base forms}) of the word, or None
+  def entry(self, word):
+    key = word.encode('utf-8')
+    low, high = 0, len(self.data)
+    while low < high:
+      start = self.data.rfind(b'\n', 0, (low + high) // 2) + 1
+      end = self.data.find(b'\n', start)
+      if end < 0:
+        end = len(self.data)
+      fields = self.data[start:end].split(b'\t')
+      if fields[0] < key:
+        low = end + 1
+      elif fields[0] > key:
+        high = start
+      else:
+        exceptions = {}
+        for exception in filter(None, fields[2].decode('utf-8').split(';')):
+          pos, forms = exception.split('=', 1)
+          exceptions[pos] = forms.split(',')
+        return fields[1].decode('utf-8'), exceptions
+    return None
+
+  def has(self, form, pos):
+    entry = self.entry(form)
+    return entry is not None and pos in entry[0]
+
+  def morphy(self, form, pos):
+    entry = self.entry(form)
+    if entry is not None and pos in entry[1]:
+      forms = entry[1][pos]
+    else:
+      forms = [form[:-len(old)] + new for old, new in MORPHOLOGICAL_SUBSTITUTIONS[pos] if form.endswith(old)]
+    return [candidate for candidate in [form] + forms if self.has(candidate, pos)]
+
+  def is_known_word(self, word):
+    form = word.lower()
+    return any(self.morphy(form, pos) for pos in POS_LIST)
+
+  # lemmas: {lemma: parts of speech}, exceptions: {pos: {form: base forms}}
+  def build(path, lemmas, exceptions):
+    entries = dict((lemma, [''.join(pos for pos in POS_LIST if pos in parts), []]) for lemma, parts in lemmas.items())
+    for pos in POS_LIST:
+      for form, bases in sorted(exceptions.get(pos, {}).items()):
+        entries.setdefault(form, ['', []])[1].append('%s=%s' % (pos, ','.join(bases)))
+    if os.path.dirname(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as lexicon_file:
+      for word in sorted(entries, key=lambda word: word.encode('utf-8')):
+        if '\t' in word or '\n' in word:
+          continue
+        parts, word_exceptions = entries[word]
+        lexicon_file.write(('%s\t%s\t%s\n' % (word, parts, ';'.join(word_exceptions))).encode('utf-8'))
+    return path
+
+  # builds the lexicon from the local WordNet corpus data
+  def from_wordnet(path):
+    from nltk.corpus import wordnet
+    wordnet.ensure_loaded()
+    lemmas = dict((lemma, set(parts)) for lemma, parts in wordnet._lemma_pos_offset_map.items())
+    return Lexicon.build(path, lemmas, dict((pos, wordnet._exception_map[pos]) for pos in POS_LIST))
@@ -1,19 +1,34 @@
 # -*- coding: utf-8 -*-
 
-from app import db
-from .taggers import StanfordTagger
-AQUSATagger = StanfordTagger()
+from app import app, db
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .indicators import IndicatorEngine
+from .chunker import ChunkGrammar
+from .lexicon import Lexicon
+from .taggers import TaggerPool, TagCache, CachingTagger, BatchingTagger
+from .notifications import Notifier
+import multiprocessing
+AQUSATagCache = TagCache(app.config['TAG_CACHE_SIZE'], app.config['TAG_CACHE_PATH'])
+# the spawned workers of ParallelAnalyzer tag on one thread, so they do not prefork
+AQUSATagger = BatchingTagger(CachingTagger(TaggerPool(app.config['TAGGER_POOL_SIZE'],
+  prefork=app.config['TAGGER_PREFORK'] and multiprocessing.current_process().name == 'MainProcess'), AQUSATagCache))
+AQUSALexicon = Lexicon.open(app.config['LEXICON_PATH'])
+AQUSANotifier = Notifier(app.config['NOTIFY_WORKERS'], app.config['NOTIFY_RETRIES'], app.config['NOTIFY_BACKOFF'], app.config['NOTIFY_TIMEOUT'])
 
 import re
-import nltk
-import pandas
+import hashlib
+import json
 import operator
-import requests
 import threading
 import os
-from collections import Counter
+from collections import Counter, OrderedDict
+from functools import partial
+from contextlib import contextmanager
 from datetime import datetime
-from nltk.corpus import wordnet
+# pandas, nltk and requests take long to import, so they are imported where
+# they are used rather than when the app starts
 # Classes: Stories, Defect, Project  
 
 class Stories(db.Model):
@@ -23,10 +38,13 @@ class Stories(db.Model):
   role = db.Column(db.Text)
   means = db.Column(db.Text)
   ends = db.Column(db.Text)
+  analysis_hash = db.Column(db.String(40))
+  title_hash = db.Column(db.String(32))
   project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
   defects = db.relationship('Defects', backref='story', lazy='dynamic', cascade='save-update, merge, delete')
   created_at = db.Column(db.DateTime, default=datetime.now)
   updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+  __table_args__ = (db.Index('ix_stories_title_hash', 'project_id', 'title_hash'),)
 
   def __repr__(self):
     return '<story: %r, title=%s>' % (self.id, self.title)
@@ -51,33 +69,70 @@ class Stories(db.Model):
     db.session.merge(self)
     return self
 
+  # inserts unchunked stories with one statement, without loading them
+  def bulk_create(titles, project_id, external_ids=None):
+    rows = [dict(title=title, title_hash=Stories.title_digest(title), external_id=external_id, project_id=project_id)
+      for title, external_id in zip(titles, external_ids or [None] * len(titles))]
+    if rows:
+      db.session.execute(Stories.__table__.insert(), rows)
+      ReportSummaries.invalidate([project_id])
+    return len(rows)
+
   def delete(self):
+    FormatCounts.ensure(self.project_id)
+    FormatCounts.apply(self.project_id, Projects.count_formats([self]), Projects.count_formats([]))
     db.session.delete(self)
     db.session.commit()
 
   def chunk(self):
-    StoryChunker.chunk_story(self)
+    with FormatCounts.track(self.project_id, [self]):
+      StoryChunker.chunk_story(self)
+    self.save()
     return self
 
   def re_chunk(self):
+    with FormatCounts.track(self.project_id, [self]):
+      self.clear_chunks()
+      StoryChunker.chunk_story(self)
+    self.save()
+    return self
+
+  def clear_chunks(self):
     self.role = None
     self.means = None
     self.ends = None
-    StoryChunker.chunk_story(self)
     return self
 
-  def analyze(self):
-    WellFormedAnalyzer.well_formed(self)
-    Analyzer.atomic(self)
-    Analyzer.unique(self)
-    MinimalAnalyzer.minimal(self)
-    Analyzer.uniform(self)
+  # also records the story's analysis hash, committed with its defects
+  def analyze(self, **context):
+    with DefectBatch.open(self.project_id, [self.id]), Analyzer.tagging([self]):
+      Analyzer.rules(self, **context)
+      self.analysis_hash = Stories.analysis_key(self.title, self.project.format)
     return self
 
-  def re_analyze(self):
-    self.analyze()
+  # after an edit; old_title is the title before it, if it changed
+  def re_analyze(self, old_title=None):
+    self.project.re_analyze([self.id], [old_title] if old_title else [])
     return self
 
+  # the inputs of a story's analysis; stories whose stored hash differs
+  # must be analyzed again
+  def analysis_key(title, project_format):
+    key = '%s\n%s\n%s' % (title, project_format, ANALYZER_VERSION)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+  def by_ids(story_ids):
+    return Stories.query.filter(Stories.id.in_(story_ids)).order_by(Stories.id).all()
+
+  # md5 of the title, which equals PostgreSQL's md5(title); stories are
+  # matched on it through ix_stories_title_hash rather than on the title
+  def title_digest(title):
+    return hashlib.md5(title.encode('utf-8')).hexdigest() if title is not None else None
+
+  # keeps title_hash in step with title for stories written by the session
+  def hash_title(mapper, connection, story):
+    story.title_hash = Stories.title_digest(story.title)
+
 
 class Projects(db.Model):
   id = db.Column(db.Integer, primary_key=True)
@@ -87,6 +142,8 @@ class Projects(db.Model):
   create_comments = db.Column(db.Boolean)
   stories = db.relationship('Stories', backref='project', lazy='dynamic', cascade='save-update, merge, delete')
   defects = db.relationship('Defects', backref='project', lazy='dynamic')
+  report_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+  format_counted = db.Column(db.Boolean, default=False, server_default='false', nullable=False)
   created_at = db.Column(db.DateTime, default=datetime.now)
   updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
@@ -106,6 +163,8 @@ class Projects(db.Model):
     return project
 
   def delete(self):
+    FormatCounts.query.filter_by(project_id=self.id).delete(synchronize_session=False)
+    ReportSummaries.query.filter_by(project_id=self.id).delete(synchronize_session=False)
     db.session.delete(self)
     db.session.commit() 
 
@@ -115,35 +174,254 @@ class Projects(db.Model):
     db.session.merge(self)
     return self
 
-  def process_csv(self, path):
-    stories = pandas.read_csv(path, header=-1)
-    for story in stories[0]: 
-      Stories.create(text=story, project_id=self.id)
-    self.analyze()
+  # imports the first column of the CSV a chunk of rows at a time, one
+  # insert and commit per chunk, then chunks and analyzes the stories
+  def process_csv(self, path, analyze=True):
+    import pandas
+    for stories in pandas.read_csv(path, header=-1, chunksize=app.config['IMPORT_CHUNK_SIZE']):
+      Stories.bulk_create([title for title in stories[0] if not pandas.isnull(title)], self.id)
+      db.session.commit()
+    if analyze: self.analyze()
     return None
 
-  def get_common_format(self):
+  # deletes the stories, their defects and the defects' comments with three
+  # statements, without loading them
+  def delete_stories(self):
+    defect_ids = db.session.query(Defects.id).filter(Defects.project_id == self.id).subquery()
+    Comments.query.filter(Comments.defect_id.in_(defect_ids)).delete(synchronize_session=False)
+    Defects.query.filter(Defects.project_id == self.id).delete(synchronize_session=False)
+    Stories.query.filter(Stories.project_id == self.id).delete(synchronize_session=False)
+    FormatCounts.query.filter_by(project_id=self.id).delete(synchronize_session=False)
+    ReportSummaries.invalidate([self.id])
+    db.session.commit()
+    return self
+
+  # formats: Counters of indicator phrases per chunk, see count_formats, that
+  # replace the stored FormatCounts. Without them the stored counts are used,
+  # and only counted from the stories if the project was never counted.
+  def get_common_format(self, formats=None):
+    if formats is None:
+      FormatCounts.ensure(self.id)
+    else:
+      FormatCounts.rebuild(self.id, formats)
     most_common_format = []
-    for chunk in ['role', 'means', 'ends']:
-      chunks = [Analyzer.extract_indicator_phrases(getattr(story,chunk), chunk) for story in self.stories]
-      chunks = list(filter(None, chunks))
-      try:
-        most_common_format += [Counter(chunks).most_common(1)[0][0].strip()]
-      except:
-        print('')
+    for chunk in CHUNKS:
+      phrase = FormatCounts.most_common(self.id, chunk)
+      if phrase: most_common_format += [phrase.strip()]
     self.format = ', '.join(most_common_format)
     if self.format == "": self.format = "As a, I want to, So that"
     self.save() 
     return "New format is: " + self.format
 
-  def analyze(self):
-    for story in self.stories.all():
-      story.re_chunk()
-    self.get_common_format()
-    for story in self.stories.all():
-      story.analyze()
+  def count_formats(stories, formats=None):
+    formats = formats or dict((chunk, Counter()) for chunk in CHUNKS)
+    for story in stories:
+      for chunk in CHUNKS:
+        indicator_phrase = Analyzer.extract_indicator_phrases(getattr(story, chunk), chunk)
+        if indicator_phrase: formats[chunk][indicator_phrase] += 1
+    return formats
+
+  # the report counts, as stored in the project's summary. Recounted when the
+  # summary was invalidated since it was stored, see ReportSummaries.
+  def report_summary(self):
+    version, summary = db.session.query(Projects.report_version, ReportSummaries) \
+      .outerjoin(ReportSummaries, ReportSummaries.project_id == Projects.id).filter(Projects.id == self.id).one()
+    if summary is not None and summary.version == version:
+      return summary.counts()
+    counts = self.report_counts()
+    # the version is bumped when the pending changes commit, so their counts
+    # are not stored
+    if self.id in db.session().info.get('report_projects', ()):
+      return counts
+    ReportSummaries.store(self.id, version, counts)
+    return counts
+
+  # defect counts per severity of the report, from one grouped query, and
+  # the number of stories and of stories without any defect
+  def report_counts(self):
+    counts = {'total': 0, 'high': 0, 'medium': 0, 'minor': 0, 'false_positives': 0}
+    query = db.session.query(Defects.severity, Defects.false_positive, db.func.count(Defects.id)) \
+      .filter(Defects.project_id == self.id).group_by(Defects.severity, Defects.false_positive)
+    for severity, false_positive, count in query:
+      if false_positive:
+        counts['false_positives'] += count
+      else:
+        counts['total'] += count
+        if severity in ['high', 'medium', 'minor']: counts[severity] += count
+    counts['stories'] = self.stories.count()
+    counts['perfect'] = self.stories.filter(~Stories.defects.any()).count()
+    return counts
+
+  # a page of the report: the stories after story id after that have defects
+  # of the given kind, or that have none at all when perfect, with their
+  # defects loaded in one query. Also returns the id to continue after, if
+  # there are more stories.
+  def report_page(self, after=0, size=None, perfect=False, false_positive=False, severity=None):
+    size = size or app.config['REPORT_PAGE_SIZE']
+    criteria = [Defects.false_positive == false_positive]
+    if severity is not None:
+      criteria.append(Defects.severity == severity)
+    stories = self.stories.filter(Stories.id > after)
+    if perfect:
+      stories = stories.filter(~Stories.defects.any())
+    else:
+      stories = stories.filter(Stories.defects.any(db.and_(*criteria)))
+    stories = stories.order_by(Stories.id).limit(size + 1).all()
+    next_after = stories[size - 1].id if len(stories) > size else None
+    stories = stories[:size]
+    defects = dict((story.id, []) for story in stories)
+    if stories and not perfect:
+      for defect in Defects.query.filter(Defects.story_id.in_(list(defects)), *criteria).order_by(Defects.id):
+        defects[defect.story_id].append(defect)
+    return stories, defects, next_after
+
+  # the project's stories after story id after, in id order, as dicts with
+  # their defects. Reads a page of columns at a time rather than objects, so
+  # that exporting a project of any size takes little memory.
+  def export_stories(self, after=0, size=None):
+    size = size or app.config['EXPORT_PAGE_SIZE']
+    while True:
+      stories = self.export_query().filter(Stories.id > after).order_by(Stories.id).limit(size).all()
+      if not stories:
+        return
+      for exported in self.with_defects(stories):
+        yield exported
+      after = stories[-1].id
+
+  def export_query(self):
+    return db.session.query(Stories.id, Stories.external_id, Stories.title, Stories.role, Stories.means, Stories.ends) \
+      .filter(Stories.project_id == self.id)
+
+  # rows of export_query as dicts, with their defects from one query
+  def with_defects(self, stories):
+    defects = dict((story.id, []) for story in stories)
+    if not defects:
+      return []
+    query = db.session.query(Defects.id, Defects.story_id, Defects.kind, Defects.subkind, Defects.severity,
+      Defects.highlight, Defects.false_positive).filter(Defects.project_id == self.id, Defects.story_id.in_(list(defects)))
+    for defect in query.order_by(Defects.id):
+      defects[defect.story_id].append(defect._asdict())
+    exported = []
+    for story in stories:
+      exported.append(story._asdict())
+      exported[-1]['defects'] = defects[story.id]
+    return exported
+
+  # adds the stories, dicts with an external_id and a title, that the project
+  # does not have yet and retitles the ones it has, in one transaction.
+  # Returns the story ids in the order given, and the ids of the stories that
+  # were added or retitled with their old titles, as re_analyze takes them.
+  def upsert_stories(self, stories):
+    titles = OrderedDict((story['external_id'], story['title']) for story in stories)
+    existing = dict((external_id, (story_id, title)) for story_id, external_id, title in db.session.query(Stories.id,
+      Stories.external_id, Stories.title).filter(Stories.project_id == self.id, Stories.external_id.in_(list(titles))))
+    retitled = [dict(story_id=story_id, new_title=titles[external_id], new_hash=Stories.title_digest(titles[external_id]), old_title=title)
+      for external_id, (story_id, title) in existing.items() if title != titles[external_id]]
+    if retitled:
+      db.session.execute(Stories.__table__.update().where(Stories.id == db.bindparam('story_id'))
+        .values(title=db.bindparam('new_title'), title_hash=db.bindparam('new_hash')), retitled)
+      ReportSummaries.invalidate([self.id])
+    new = [external_id for external_id in titles if external_id not in existing]
+    Stories.bulk_create([titles[external_id] for external_id in new], self.id, new)
+    story_ids = dict((external_id, story_id) for external_id, (story_id, title) in existing.items())
+    if new:
+      story_ids.update((external_id, story_id) for story_id, external_id in db.session.query(Stories.id, Stories.external_id)
+        .filter(Stories.project_id == self.id, Stories.external_id.in_(new)))
+    db.session.commit()
+    changed = [row['story_id'] for row in retitled] + [story_ids[external_id] for external_id in new]
+    return [story_ids[external_id] for external_id in titles], changed, [row['old_title'] for row in retitled]
+
+  # chunks and analyzes what upsert_stories changed, see re_analyze, and
+  # exports the stories with their defects in the order given
+  def analyze_submitted(self, story_ids, changed, titles):
+    self.re_analyze(changed, titles)
+    exported = dict((story['id'], story) for story in self.with_defects(self.export_query().filter(Stories.id.in_(story_ids)).all()))
+    return [exported[story_id] for story_id in story_ids]
+
+  # stories in id order, a window at a time, so that only one window is
+  # loaded into the session at once
+  def story_windows(self, size=None):
+    size = size or app.config['ANALYSIS_WINDOW']
+    last_id = 0
+    while True:
+      stories = self.stories.filter(Stories.id > last_id).order_by(Stories.id).limit(size).all()
+      if not stories:
+        break
+      last_id = stories[-1].id
+      yield stories
+
+  # chunks every window and counts its indicator phrases, then analyzes
+  # every window against the project format; one commit per window.
+  # progress(stage, done, total) is called after every window. With more
+  # than one process the windows are analyzed by ParallelAnalyzer instead.
+  def analyze(self, progress=None, processes=None):
+    processes = processes or app.config['ANALYSIS_PROCESSES']
+    if processes > 1:
+      with AQUSANotifier.coalesce():
+        return ParallelAnalyzer.analyze(self, processes, progress)
+    total = self.stories.count()
+    formats, done = None, 0
+    for stories in self.story_windows():
+      for story in stories:
+        story.clear_chunks()
+      StoryChunker.chunk_stories(stories)
+      formats = Projects.count_formats(stories, formats)
+      db.session.commit()
+      done += len(stories)
+      if progress: progress('chunk', done, total)
+    self.get_common_format(formats)
+    context = Analyzer.project_context(self)
+    done = 0
+    with AQUSANotifier.coalesce():
+      for stories in self.story_windows():
+        self.analyze_window(stories, **context)
+        done += len(stories)
+        if progress: progress('analyze', done, total)
     return self
 
+  # runs the rules on a window of chunked stories, which records their
+  # analysis hash, and drops the identical defects of those that no longer
+  # share their title
+  # context: the project-wide rule inputs, see Analyzer.project_context
+  def analyze_window(self, stories, **context):
+    story_ids = [story.id for story in stories]
+    with DefectBatch.open(self.id, story_ids), Analyzer.tagging(stories):
+      Defects.drop_identical(self.id, [story_id for story_id in story_ids if story_id not in context['duplicates']])
+      for story in stories:
+        story.analyze(**context)
+    return stories
+
+  # analyzes only the stories whose inputs changed: the edited stories in
+  # story_ids, the stories sharing one of their old titles or their new
+  # title, and stories whose analysis hash is out of date, e.g. because the
+  # common format flipped. Only the edited and never analyzed stories are
+  # chunked again.
+  def re_analyze(self, story_ids=(), titles=()):
+    changed = set(story_ids)
+    stories = db.session.query(Stories.id, Stories.title, Stories.analysis_hash).filter_by(project_id=self.id).order_by(Stories.id).all()
+    titles = set(titles) | set(title for story_id, title, analysis_hash in stories if story_id in changed)
+    rechunk = [story_id for story_id, title, analysis_hash in stories if story_id in changed or analysis_hash is None]
+    for window in Projects.windows(rechunk):
+      window = Stories.by_ids(window)
+      with FormatCounts.track(self.id, window):
+        for story in window:
+          story.clear_chunks()
+        StoryChunker.chunk_stories(window)
+      db.session.commit()
+    self.get_common_format()
+    context = Analyzer.project_context(self)
+    rechunk = set(rechunk)
+    stale = [story_id for story_id, title, analysis_hash in stories if story_id in rechunk or title in titles
+      or analysis_hash != Stories.analysis_key(title, self.format)]
+    with AQUSANotifier.coalesce():
+      for window in Projects.windows(stale):
+        self.analyze_window(Stories.by_ids(window), **context)
+    return stale
+
+  def windows(items, size=None):
+    size = size or app.config['ANALYSIS_WINDOW']
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
 class Defects(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   highlight = db.Column(db.Text, nullable=False)
@@ -151,11 +429,13 @@ class Defects(db.Model):
   subkind = db.Column(db.String(120), nullable=False)
   severity = db.Column(db.String(120), nullable=False)
   false_positive = db.Column(db.Boolean, default=False, nullable=False)
+  key_hash = db.Column(db.String(32))
   story_id = db.Column(db.Integer, db.ForeignKey('stories.id'), nullable=False)
   project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
   comments = db.relationship('Comments', backref='defect', lazy='dynamic')
   created_at = db.Column(db.DateTime, default=datetime.now)
   updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+  __table_args__ = (db.Index('ix_defects_key_hash', 'story_id', 'key_hash', 'false_positive'),)
 
   def __repr__(self):
     return '<Defect: %s, highlight=%s, kind=%s>' % (self.id, self.highlight, self.kind)
@@ -177,11 +457,26 @@ class Defects(db.Model):
     db.session.merge(self)
     return self
 
+  # deletes the identical defects, and their comments, of stories that no
+  # longer share their title with another story; false positives are kept.
+  # The caller commits.
+  def drop_identical(project_id, story_ids):
+    if not story_ids:
+      return
+    defect_ids = db.session.query(Defects.id).filter(Defects.project_id == project_id, Defects.story_id.in_(story_ids),
+      Defects.kind == 'unique', Defects.subkind == 'identical', Defects.false_positive == False).subquery()
+    Comments.query.filter(Comments.defect_id.in_(defect_ids)).delete(synchronize_session=False)
+    Defects.query.filter(Defects.id.in_(defect_ids)).delete(synchronize_session=False)
+    ReportSummaries.invalidate([project_id])
+
   def create_unless_duplicate(highlight, kind, subkind, severity, story):
+    batch = DefectBatch.active()
+    if batch is not None:
+      return batch.add(highlight, kind, subkind, severity, story)
     project = story.project
     defect = Defects(highlight=highlight, kind=kind, subkind=subkind, severity=severity, story_id=story.id, project_id=project.id)
-    duplicates = Defects.query.filter_by(highlight=highlight, kind=kind, subkind=subkind,
-      severity=severity, story_id=story.id, project_id=project.id, false_positive=False).all()
+    duplicates = Defects.query.filter_by(story_id=story.id, key_hash=Defects.key_digest(kind, subkind, severity, highlight),
+      false_positive=False, highlight=highlight, kind=kind, subkind=subkind, severity=severity, project_id=project.id).all()
     if duplicates:
       return 'duplicate'
     else:
@@ -192,14 +487,168 @@ class Defects(db.Model):
         Defects.send_comment(os.environ['FRONTEND_URL'], str(defect.id))
       return defect
 
+  # queued on AQUSANotifier; within an analysis run, sent once it is done
   def send_comment(url, defect_id):
-    r = requests.get("%s/defects/%s/create_comments" % (url, defect_id))
+    return AQUSANotifier.notify("%s/defects/%s/create_comments" % (url, defect_id))
 
   def correct_minor_issue(self):
     story = self.story
     CorrectDefect.correct_minor_issue(self)
     return story
 
+  # md5 of what makes two defects of a story the same, which equals
+  # PostgreSQL's md5(kind || E'\n' || subkind || E'\n' || severity || E'\n' || highlight)
+  def key_digest(kind, subkind, severity, highlight):
+    return hashlib.md5('\n'.join([kind, subkind, severity, highlight]).encode('utf-8')).hexdigest()
+
+  def hash_key(mapper, connection, defect):
+    defect.key_hash = Defects.key_digest(defect.kind, defect.subkind, defect.severity, defect.highlight)
+
+# Unit of work for the defects found during an analysis. New defects are
+# checked against the keys of the defects already stored, loaded once, and
+# are written with one bulk insert when the batch is closed. A key is the
+# story id and the defect's key_hash.
+class DefectBatch(object):
+  local = threading.local()
+
+  def __init__(self, project_id, story_ids=None):
+    self.project_id = project_id
+    self.rows = []
+    query = db.session.query(Defects.story_id, Defects.key_hash).filter_by(project_id=project_id, false_positive=False)
+    if story_ids is not None:
+      query = query.filter(Defects.story_id.in_(story_ids))
+    self.keys = set(tuple(key) for key in query)
+
+  # the batch defects are currently collected in, if any
+  def active():
+    return getattr(DefectBatch.local, 'batch', None)
+
+  # collects into the active batch, or into a new one that is left uncommitted
+  @contextmanager
+  def collect(project_id, story_ids=None):
+    if DefectBatch.active() is not None:
+      yield DefectBatch.active()
+      return
+    batch = DefectBatch(project_id, story_ids)
+    DefectBatch.local.batch = batch
+    try:
+      yield batch
+    finally:
+      DefectBatch.local.batch = None
+
+  # collects into the active batch, or into a new one that is committed on exit
+  @contextmanager
+  def open(project_id, story_ids=None):
+    outer = DefectBatch.active()
+    with DefectBatch.collect(project_id, story_ids) as batch:
+      yield batch
+    if outer is None: batch.commit()
+
+  def add(self, highlight, kind, subkind, severity, story):
+    return self.add_row(dict(highlight=highlight, kind=kind, subkind=subkind, severity=severity,
+      story_id=story.id, project_id=self.project_id, false_positive=False))
+
+  def add_row(self, row):
+    row['key_hash'] = Defects.key_digest(row['kind'], row['subkind'], row['severity'], row['highlight'])
+    key = (row['story_id'], row['key_hash'])
+    if key in self.keys:
+      return 'duplicate'
+    self.keys.add(key)
+    self.rows.append(row)
+    return row
+
+  # also commits whatever else the session holds, e.g. analysis hashes
+  def commit(self):
+    defect_ids = []
+    if self.rows and Projects.query.get(self.project_id).create_comments == True:
+      defects = [Defects(**row) for row in self.rows]
+      db.session.add_all(defects)
+      db.session.flush()
+      defect_ids = [defect.id for defect in defects]
+    elif self.rows:
+      db.session.execute(Defects.__table__.insert(), self.rows)
+    ReportSummaries.invalidate([self.project_id])
+    db.session.commit()
+    with AQUSANotifier.coalesce():
+      for defect_id in defect_ids:
+        Defects.send_comment(os.environ['FRONTEND_URL'], str(defect_id))
+    self.rows = []
+    return defect_ids
+
+# Analyzes a project on a pool of processes, each with its own tagger and
+# database session. Stories are sharded into id windows. The workers chunk
+# them and count their formats, then the parent picks the project format and
+# the duplicates, then the workers run the rules. Defects are returned to the
+# parent, which persists them shard by shard in id order, so the outcome does
+# not depend on which worker finishes first.
+#
+# The workers are spawned rather than forked: the parent is often a job or
+# web thread while other threads, e.g. of the tagger pool and the notifier,
+# may hold locks that a forked child would inherit held. A spawned worker
+# imports the app afresh, with its own tagger, cache and connections.
+class ParallelAnalyzer:
+
+  def analyze(project, processes, progress=None):
+    shards = ParallelAnalyzer.shards(project.id)
+    total = sum(len(shard) for shard in shards)
+    formats = dict((chunk, Counter()) for chunk in CHUNKS)
+    with multiprocessing.get_context('spawn').Pool(processes, prepare_worker, [app.config['SQLALCHEMY_DATABASE_URI']]) as pool:
+      done = 0
+      # the workers only see what the parent committed
+      db.session.commit()
+      for shard, shard_formats in zip(shards, pool.imap(chunk_shard, shards)):
+        for chunk in CHUNKS:
+          formats[chunk].update(shard_formats[chunk])
+        done += len(shard)
+        if progress: progress('chunk', done, total)
+      project.get_common_format(formats)
+      context = Analyzer.project_context(project)
+      done = 0
+      db.session.commit()
+      results = pool.imap(partial(analyze_shard, project.id, context), shards)
+      for shard, (rows, hashes) in zip(shards, results):
+        with DefectBatch.open(project.id, shard) as batch:
+          Defects.drop_identical(project.id, [story_id for story_id in shard if story_id not in context['duplicates']])
+          for row in rows:
+            batch.add_row(row)
+          db.session.execute(Stories.__table__.update().where(Stories.id == db.bindparam('story_id')).values(analysis_hash=db.bindparam('hash')),
+            [dict(story_id=story_id, hash=analysis_hash) for story_id, analysis_hash in hashes.items()])
+        done += len(shard)
+        if progress: progress('analyze', done, total)
+    return project
+
+  # story ids of the project in id order, a window at a time
+  def shards(project_id, size=None):
+    size = size or app.config['ANALYSIS_WINDOW']
+    story_ids = [story_id for story_id, in db.session.query(Stories.id).filter_by(project_id=project_id).order_by(Stories.id)]
+    return Projects.windows(story_ids, size)
+
+# the work of ParallelAnalyzer's workers; module level functions, as the
+# pool pickles them by name. The workers use the parent's database, which
+# need not be the one of the environment, e.g. in tests.
+def prepare_worker(database_uri):
+  app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+
+def chunk_shard(story_ids):
+  with app.app_context():
+    stories = Stories.by_ids(story_ids)
+    for story in stories:
+      story.clear_chunks()
+    StoryChunker.chunk_stories(stories)
+    formats = Projects.count_formats(stories)
+    db.session.commit()
+    return formats
+
+def analyze_shard(project_id, context, story_ids):
+  with app.app_context():
+    stories = Stories.by_ids(story_ids)
+    with DefectBatch.collect(project_id, story_ids) as batch, Analyzer.tagging(stories):
+      for story in stories:
+        story.analyze(**context)
+    hashes = dict((story.id, Stories.analysis_key(story.title, story.project.format)) for story in stories)
+    db.session.rollback()
+    return batch.rows, hashes
+
 class Comments(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   external_id = db.Column(db.String)
@@ -213,29 +662,290 @@ class Comments(db.Model):
     db.session.delete(self)
     db.session.commit()
 
+# How often each indicator phrase opens the role, means or ends chunk of a
+# project's stories. Kept up to date as stories are chunked and deleted, so
+# the project format is a lookup of the top phrase per chunk.
+class FormatCounts(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+  chunk = db.Column(db.String(20), nullable=False)
+  phrase = db.Column(db.Text, nullable=False)
+  count = db.Column(db.Integer, default=0, nullable=False)
+  __table_args__ = (db.Index('ix_format_counts_lookup', 'project_id', 'chunk', 'count'),
+    db.UniqueConstraint('project_id', 'chunk', 'phrase', name='uq_format_counts_phrase'))
+
+  def __repr__(self):
+    return '<FormatCounts: %s, chunk=%s, phrase=%s, count=%s>' % (self.project_id, self.chunk, self.phrase, self.count)
+
+  # ties go to the phrase counted first, as with Counter.most_common
+  def most_common(project_id, chunk):
+    row = db.session.query(FormatCounts.phrase).filter(FormatCounts.project_id == project_id,
+      FormatCounts.chunk == chunk, FormatCounts.count > 0).order_by(FormatCounts.count.desc(), FormatCounts.id).first()
+    return row[0] if row else None
+
+  def rebuild(project_id, formats):
+    FormatCounts.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+    rows = [dict(project_id=project_id, chunk=chunk, phrase=phrase, count=count)
+      for chunk in CHUNKS for phrase, count in formats[chunk].items()]
+    if rows:
+      db.session.execute(FormatCounts.__table__.insert(), rows)
+    db.session.execute(Projects.__table__.update().where(Projects.id == project_id)
+      .values(format_counted=True, updated_at=Projects.updated_at))
+
+  # counts the project's stories the first time their counts are needed, so
+  # that deltas are never applied to a project whose stories were not counted,
+  # e.g. one from before format_counts existed. A project stays counted, so
+  # only an uncounted one is locked, until the caller commits, so that
+  # concurrent first edits do not both count.
+  def ensure(project_id):
+    counted = db.session.query(Projects.format_counted).filter(Projects.id == project_id)
+    if not counted.scalar() and not counted.with_for_update().scalar():
+      stories = db.session.query(Stories.role, Stories.means, Stories.ends).filter_by(project_id=project_id)
+      FormatCounts.rebuild(project_id, Projects.count_formats(stories))
+
+  # adds the difference between two count_formats results, to counts that
+  # ensure() made complete; the caller commits
+  def apply(project_id, before, after):
+    for chunk in CHUNKS:
+      delta = Counter(after[chunk])
+      delta.subtract(before[chunk])
+      for phrase, change in delta.items():
+        if change == 0:
+          continue
+        updated = FormatCounts.query.filter_by(project_id=project_id, chunk=chunk, phrase=phrase) \
+          .update({'count': FormatCounts.count + change}, synchronize_session=False)
+        if not updated:
+          FormatCounts.insert(project_id, chunk, phrase, change)
+
+  # a new phrase, or the update of one that a concurrent edit inserted first
+  def insert(project_id, chunk, phrase, count):
+    try:
+      with db.session.begin_nested():
+        db.session.add(FormatCounts(project_id=project_id, chunk=chunk, phrase=phrase, count=count))
+    except IntegrityError:
+      FormatCounts.query.filter_by(project_id=project_id, chunk=chunk, phrase=phrase) \
+        .update({'count': FormatCounts.count + count}, synchronize_session=False)
+
+  # counts the phrases the stories lose and gain while they are re-chunked
+  @contextmanager
+  def track(project_id, stories):
+    FormatCounts.ensure(project_id)
+    before = Projects.count_formats(stories)
+    yield
+    FormatCounts.apply(project_id, before, Projects.count_formats(stories))
+
+# The report counts of a project, see Projects.report_counts, stored so that
+# the report is one lookup. Changes to the project's stories or defects bump
+# the project's report_version, once per transaction as it commits, and a
+# summary only counts as current for the version it was counted at. A
+# summary that was being counted while stories or defects changed is thus
+# never used.
+class ReportSummaries(db.Model):
+  project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), primary_key=True)
+  version = db.Column(db.Integer, nullable=False)
+  stories = db.Column(db.Integer, nullable=False)
+  perfect = db.Column(db.Integer, nullable=False)
+  total = db.Column(db.Integer, nullable=False)
+  high = db.Column(db.Integer, nullable=False)
+  medium = db.Column(db.Integer, nullable=False)
+  minor = db.Column(db.Integer, nullable=False)
+  false_positives = db.Column(db.Integer, nullable=False)
+
+  def __repr__(self):
+    return '<ReportSummaries: %s, version=%s>' % (self.project_id, self.version)
+
+  def counts(self):
+    return dict((key, getattr(self, key)) for key in REPORT_COUNTS)
+
+  # the summary counted at version; another request may have stored it first
+  def store(project_id, version, counts):
+    values = dict((key, counts[key]) for key in REPORT_COUNTS)
+    values['version'] = version
+    try:
+      updated = ReportSummaries.query.filter_by(project_id=project_id).update(values, synchronize_session=False)
+      if not updated:
+        db.session.add(ReportSummaries(project_id=project_id, **values))
+      db.session.commit()
+    except IntegrityError:
+      db.session.rollback()
+
+  # for writes that bypass the session, e.g. bulk inserts and deletes. The
+  # versions are bumped once, when the transaction commits, so the project
+  # rows are only locked while it commits rather than while, say, a window
+  # of stories is analyzed.
+  def invalidate(project_ids, session=None):
+    session = session or db.session()
+    session.info.setdefault('report_projects', set()).update(project_ids)
+
+  # pending ids left by a rollback are bumped with the next commit, which
+  # only costs a recount
+  def bump_versions(session):
+    if session.transaction.nested: return
+    if session.info.get('report_projects'):
+      session.flush()
+    project_ids = sorted(session.info.pop('report_projects', ()))
+    if project_ids:
+      session.execute(Projects.__table__.update().where(Projects.id.in_(project_ids))
+        .values(report_version=Projects.report_version + 1, updated_at=Projects.updated_at))
+
+  # for the stories and defects that a flush adds, changes or deletes
+  def invalidate_flushed(session, flush_context, instances):
+    changed = list(session.new) + list(session.deleted) + [instance for instance in session.dirty if session.is_modified(instance)]
+    ReportSummaries.invalidate([instance.project_id for instance in changed
+      if isinstance(instance, (Stories, Defects)) and instance.project_id is not None], session)
+
+event.listen(Session, 'before_flush', ReportSummaries.invalidate_flushed)
+event.listen(Session, 'before_commit', ReportSummaries.bump_versions)
+event.listen(Stories, 'before_insert', Stories.hash_title)
+event.listen(Stories, 'before_update', Stories.hash_title)
+event.listen(Defects, 'before_insert', Defects.hash_key)
+event.listen(Defects, 'before_update', Defects.hash_key)
+
+REPORT_COUNTS = ['stories', 'perfect', 'total', 'high', 'medium', 'minor', 'false_positives']
+
+# The state of the background jobs, see app.jobs, so that any web process can
+# answer for a job and finished jobs outlive a restart. A job that was still
+# running when its process stopped keeps the last state it stored.
+class Jobs(db.Model):
+  id = db.Column(db.String(32), primary_key=True)
+  name = db.Column(db.String(120), nullable=False)
+  status = db.Column(db.String(20), nullable=False)
+  stage = db.Column(db.String(120))
+  done = db.Column(db.Integer, default=0, nullable=False)
+  total = db.Column(db.Integer)
+  result = db.Column(db.Text)
+  error = db.Column(db.Text)
+  created_at = db.Column(db.DateTime, nullable=False)
+  finished_at = db.Column(db.DateTime)
+
+  def __repr__(self):
+    return '<Jobs: %s, name=%s, status=%s>' % (self.id, self.name, self.status)
+
+  # the store of a JobQueue. Writes on its own connection and commits at
+  # once, apart from the session of the work the job is doing.
+  def store(job):
+    values = dict(name=job.name, status=job.status, stage=job.stage, done=job.done, total=job.total,
+      result=json.dumps(job.result) if job.finished else None, error=job.error,
+      created_at=job.created_at, finished_at=job.finished_at)
+    with db.engine.begin() as connection:
+      updated = connection.execute(Jobs.__table__.update().where(Jobs.id == job.id).values(**values)).rowcount
+      if not updated:
+        connection.execute(Jobs.__table__.insert().values(id=job.id, **values))
+
+  # as Job.serialize gives it
+  def serialize(self):
+    return {'id': self.id, 'name': self.name, 'status': self.status, 'stage': self.stage,
+      'done': self.done, 'total': self.total, 'result': json.loads(self.result) if self.result else None,
+      'error': self.error, 'created_at': self.created_at.isoformat(),
+      'finished_at': self.finished_at.isoformat() if self.finished_at else None}
+
+# bump whenever a change to the chunker or the rules alters their outcome,
+# so that re-analysis does not skip stories analyzed by the old version
+ANALYZER_VERSION = 2
 
 ROLE_INDICATORS = ["^As an ", "^As a ", "^As "]
 MEANS_INDICATORS = ["[, ]I'm able to ", "[, ]I am able to ", "[, ]I want to ", "[, ]I wish to ", "[, ]I can ", "[, ]I want ", "[, ]I should be able to "]
 ENDS_INDICATORS = ["[, ]So that ", "[, ]In order to ", "[, ]So "]
+INDICATORS = IndicatorEngine({'role': ROLE_INDICATORS, 'means': MEANS_INDICATORS, 'ends': ENDS_INDICATORS})
 CONJUNCTIONS = [' and ', '&', '\+', ' or ', '>', '<', '/', '\\']
 PUNCTUATION = ['.', ';', ':', '‒', '–', '—', '―', '‐', '-', '?', '*']
 BRACKETS = [['(', ')'], ['[', ']'], ['{', '}'], ['⟨', '⟩']]
-ERROR_KINDS = { 'well_formed_content': [
-                  { 'subkind': 'means', 'rule': 'Analyzer.well_formed_content_rule(story.means, "means", ["means"])', 'severity':'medium', 'highlight':'str("Make sure the means includes a verb and a noun. Our analysis shows the means currently includes: ") + Analyzer.well_formed_content_highlight(story.means, "means")'},
-                  { 'subkind': 'role', 'rule': 'Analyzer.well_formed_content_rule(story.role, "role", ["NP"])', 'severity':'medium', 'highlight':'str("Make sure the role includes a person noun. Our analysis shows the role currently includes: ") + Analyzer.well_formed_content_highlight(story.role, "role")'},
-                ],
-
-                'atomic': [
-                  { 'subkind':'conjunctions', 'rule':"Analyzer.atomic_rule(getattr(story,chunk), chunk)", 'severity':'high', 'highlight':"Analyzer.highlight_text(story, CONJUNCTIONS, 'high')"}
-                ],
-                'unique': [
-                  { 'subkind':'identical', 'rule':"Analyzer.identical_rule(story)", 'severity':'high', 'highlight':'str("Remove all duplicate user stories")' }
-                ],
-                'uniform': [
-                  { 'subkind':'uniform', 'rule':"Analyzer.uniform_rule(story)", 'severity':'medium', 'highlight':'"Use the most common template: %s" % story.project.format'}
-                ],
-
-              }
+CHUNKS = ['role', 'means', 'ends']
+# kinds in the order a story's defects are created, see Analyzer.rules
+ANALYSIS_ORDER = ['well_formed', 'atomic', 'unique', 'minimal', 'uniform']
+
+# A defect rule: check(story, **inputs) tells whether the story has the
+# defect and highlight(story, **inputs) describes it. Inputs name what the
+# rule needs besides the story; 'chunk' runs the rule once per story chunk,
+# other inputs come from the analysis context.
+class Rule(object):
+  def __init__(self, kind, subkind, severity, check, highlight, inputs=(), enabled=True):
+    self.kind = kind
+    self.subkind = subkind
+    self.severity = severity
+    self.check = check
+    self.highlight = highlight
+    self.inputs = list(inputs)
+    self.enabled = enabled
+
+  def __repr__(self):
+    return '<Rule: %s/%s>' % (self.kind, self.subkind)
+
+  def input_sets(self, context):
+    inputs = dict((name, context.get(name)) for name in self.inputs if name != 'chunk')
+    if 'chunk' not in self.inputs:
+      return [inputs]
+    return [dict(inputs, chunk=chunk) for chunk in CHUNKS]
+
+class RuleRegistry(object):
+  def __init__(self):
+    self.rules = []
+
+  def __iter__(self):
+    return iter([rule for rule in self.rules if rule.enabled])
+
+  def add(self, rule):
+    self.rules.append(rule)
+    return rule
+
+  # decorator for rules defined outside this module:
+  #   @RULES.register('minimal', 'too_long', 'minor', lambda story: 'Shorten the story')
+  #   def too_long(story): ...
+  def register(self, kind, subkind, severity, highlight, inputs=()):
+    def decorator(check):
+      self.add(Rule(kind, subkind, severity, check, highlight, inputs))
+      return check
+    return decorator
+
+  def kind(self, kind):
+    return [rule for rule in self if rule.kind == kind]
+
+  # the kinds in first, then those of the other enabled rules as registered
+  def kinds(self, first=()):
+    kinds = list(first)
+    for rule in self:
+      if rule.kind not in kinds: kinds.append(rule.kind)
+    return kinds
+
+RULES = RuleRegistry()
+# well_formed_content is not part of the analysis pipeline yet
+RULES.add(Rule('well_formed_content', 'means', 'medium',
+  lambda story: Analyzer.well_formed_content_rule(story.means, "means", ["means"], story),
+  lambda story: "Make sure the means includes a verb and a noun. Our analysis shows the means currently includes: " + Analyzer.well_formed_content_highlight(story.means, "means", story),
+  enabled=False))
+RULES.add(Rule('well_formed_content', 'role', 'medium',
+  lambda story: Analyzer.well_formed_content_rule(story.role, "role", ["NP"], story),
+  lambda story: "Make sure the role includes a person noun. Our analysis shows the role currently includes: " + Analyzer.well_formed_content_highlight(story.role, "role", story),
+  enabled=False))
+RULES.add(Rule('well_formed', 'no_means', 'high',
+  lambda story: WellFormedAnalyzer.no_means(story),
+  lambda story: 'Add what you want to achieve'))
+RULES.add(Rule('well_formed', 'no_role', 'high',
+  lambda story: WellFormedAnalyzer.no_role(story),
+  lambda story: 'Add for who this story is'))
+RULES.add(Rule('minimal', 'punctuation', 'high',
+  lambda story: MinimalAnalyzer.punctuation(story),
+  lambda story: MinimalAnalyzer.punctuation_highlight(story, 'high')))
+RULES.add(Rule('minimal', 'brackets', 'high',
+  lambda story: MinimalAnalyzer.brackets(story),
+  lambda story: MinimalAnalyzer.brackets_highlight(story, 'high')))
+RULES.add(Rule('minimal', 'indicator_repetition', 'high',
+  lambda story, chunk: MinimalAnalyzer.indicator_repetition(story, chunk),
+  lambda story, chunk: MinimalAnalyzer.indicator_repetition_highlight(story.title, MinimalAnalyzer.repeated_indicators(story)[chunk], 'high'),
+  inputs=['chunk']))
+RULES.add(Rule('atomic', 'conjunctions', 'high',
+  lambda story, chunk: Analyzer.atomic_rule(getattr(story, chunk), chunk, story),
+  lambda story, chunk: Analyzer.highlight_text(story, CONJUNCTIONS, 'high'),
+  inputs=['chunk']))
+RULES.add(Rule('unique', 'identical', 'high',
+  lambda story, duplicates: Analyzer.identical_rule(story, duplicates),
+  lambda story, duplicates: "Remove all duplicate user stories",
+  inputs=['duplicates']))
+RULES.add(Rule('uniform', 'uniform', 'medium',
+  lambda story, uniform_verdicts: Analyzer.uniform_rule(story, uniform_verdicts),
+  lambda story, uniform_verdicts: "Use the most common template: %s" % story.project.format,
+  inputs=['uniform_verdicts']))
+
 CHUNK_GRAMMAR = """
       NP: {<DT|JJ|NN.*>}
       NNP: {<NNP.*>}
@@ -244,12 +954,13 @@ CHUNK_GRAMMAR = """
       MEANS: {<AP>?<VP>}
       ENDS: {<AP>?<VP>}
     """
+CHUNKER = ChunkGrammar(CHUNK_GRAMMAR)
+ATOMIC_TAGS = {'means': ['MEANS'], 'role': ['NP']}
 SPECIAL_WORDS = {'import': 'VP', "export": 'VP', 'select': 'VP', 'support': 'VP'}
 
 class Analyzer:
   def atomic(story):
-    for chunk in ['"role"', '"means"', '"ends"']:
-      Analyzer.generate_defects('atomic', story, chunk=chunk)
+    Analyzer.generate_defects('atomic', story)
     return story
 
   def unique(story):
@@ -260,33 +971,67 @@ class Analyzer:
     Analyzer.generate_defects('uniform', story)
     return story
 
-  def generate_defects(kind, story, **kwargs):
-    for kwarg in kwargs:
-      exec(kwarg+'='+ str(kwargs[kwarg]))
-    for defect_type in ERROR_KINDS[kind]:
-      if eval(defect_type['rule']):
-        Defects.create_unless_duplicate(eval(defect_type['highlight']), kind, defect_type['subkind'], defect_type['severity'], story)
+  # the rule inputs shared by every story of the project, computed once per
+  # analysis of the project
+  def project_context(project):
+    return dict(duplicates=Analyzer.duplicate_stories(project.id),
+      uniform_verdicts=UniformVerdicts(project.format))
+
+  # the defects of every kind in ANALYSIS_ORDER, then those of rules
+  # registered for other kinds
+  def rules(story, **context):
+    for kind in RULES.kinds(ANALYSIS_ORDER):
+      Analyzer.generate_defects(kind, story, **context)
+    return story
+
+  def generate_defects(kind, story, **context):
+    for rule in RULES.kind(kind):
+      Analyzer.apply_rule(rule, story, **context)
+
+  def apply_rule(rule, story, **context):
+    for inputs in rule.input_sets(context):
+      if rule.check(story, **inputs):
+        Defects.create_unless_duplicate(rule.highlight(story, **inputs), rule.kind, rule.subkind, rule.severity, story)
 
   def inject_text(text, severity='medium'):
     return "<span class='highlight-text severity-" + severity + "'>%s</span>" % text
 
-  def atomic_rule(chunk, kind):
+  def atomic_rule(chunk, kind, story=None):
     sentences_invalid = []
+    if kind in ATOMIC_TAGS:
+      parts = Analyzer.atomic_parts(chunk, kind)
+      sentences_invalid = Analyzer.well_formed_content_rules(parts, kind, ATOMIC_TAGS[kind], story)
+    return sentences_invalid.count(False) > 1
+
+  def atomic_parts(chunk, kind):
+    parts = []
     if chunk: 
       for x in CONJUNCTIONS:
         if x in chunk.lower():
           if kind == 'means':
-            for means in re.split(x, chunk, flags=re.IGNORECASE):
-              if means:
-                sentences_invalid.append(Analyzer.well_formed_content_rule(means, 'means', ['MEANS']))
+            parts += [means for means in re.split(x, chunk, flags=re.IGNORECASE) if means]
           if kind == 'role':
             kontinue = True
             if x in ['&', '+']: kontinue = Analyzer.symbol_in_role_exception(chunk, x)
             if kontinue:
-              for role in re.split(x, chunk, flags=re.IGNORECASE):
-                if role:
-                  sentences_invalid.append(Analyzer.well_formed_content_rule(role, "role", ["NP"]))
-    return sentences_invalid.count(False) > 1
+              parts += [role for role in re.split(x, chunk, flags=re.IGNORECASE) if role]
+    return parts
+
+  # every text the rules of a story will send to the tagger
+  def tagging_candidates(story):
+    candidates = []
+    for chunk in ATOMIC_TAGS:
+      candidates += Analyzer.atomic_parts(getattr(story, chunk), chunk)
+    return candidates
+
+  # tags every title once; the candidates that are not whole tokens of their
+  # title are tagged in bulk
+  @contextmanager
+  def tagging(stories):
+    candidates = [(text, story.title) for story in stories for text in Analyzer.tagging_candidates(story)]
+    with AQUSATagger.plan([story.title for story in stories]), \
+      AQUSATagger.batch([text for text, title in candidates], [title for text, title in candidates]):
+      yield
 
   def symbol_in_role_exception(chunk, conjunction):
     surrounding_words = Analyzer.get_surrounding_words(chunk, conjunction)
@@ -320,14 +1065,34 @@ class Analyzer:
   def surrounding_words_valid(word_array):
     result = False
     for word in word_array:
-      if not wordnet.synsets(word): result = True
+      if not Analyzer.is_known_word(word): result = True
     return result
+
+  # whether WordNet knows the word; falls back to loading WordNet itself
+  # until the lexicon is built with ./manage.py build_lexicon
+  def is_known_word(word):
+    if AQUSALexicon is not None:
+      return AQUSALexicon.is_known_word(word)
+    from nltk.corpus import wordnet
+    return bool(wordnet.synsets(word))
     
 
-  def identical_rule(story):
-    identical_stories = Stories.query.filter((Stories.title==story.title) & (Stories.project_id == int(story.project_id))).all()
-    identical_stories.remove(story)
-    return (True if identical_stories else False)
+  # duplicates: ids of the project's duplicate stories, when already known
+  def identical_rule(story, duplicates=None):
+    if duplicates is None:
+      duplicates = Analyzer.duplicate_stories(story.project_id, [story.title])
+    return story.id in duplicates
+
+  # ids of the stories that share their exact title with another story of
+  # the project. The titles are grouped by the database, so only the
+  # duplicates are read. titles limits the search to those titles.
+  def duplicate_stories(project_id, titles=None):
+    project_stories = db.session.query(Stories.title_hash).filter(Stories.project_id == int(project_id))
+    if titles is not None:
+      project_stories = project_stories.filter(Stories.title_hash.in_([Stories.title_digest(title) for title in titles]))
+    duplicate_titles = project_stories.group_by(Stories.title_hash).having(db.func.count(Stories.id) > 1)
+    query = db.session.query(Stories.id).filter(Stories.project_id == int(project_id), Stories.title_hash.in_(duplicate_titles.subquery()))
+    return set(story_id for story_id, in query)
 
   def highlight_text(story, word_array, severity):
     indices = []
@@ -342,38 +1107,46 @@ class Analyzer:
     return text
 
   # result indicates whether the story_part contains a well_formed error
-  def well_formed_content_rule(story_part, kind, tags):
-    result = Analyzer.content_chunk(story_part, kind)
+  def well_formed_content_rule(story_part, kind, tags, story=None):
+    labels = CHUNKER.labels(Analyzer.content_tags(story_part, kind, story))
     well_formed = True
     for tag in tags:
-      for x in result.subtrees():
-        if tag.upper() in x.label(): well_formed = False
+      for label in labels:
+        if tag.upper() in label: well_formed = False
     return well_formed
 
-  def uniform_rule(story):
-    project_format = story.project.format.split(',')
+  def well_formed_content_rules(story_parts, kind, tags, story=None):
+    with AQUSATagger.batch(story_parts, [story.title if story else None] * len(story_parts)):
+      return [Analyzer.well_formed_content_rule(story_part, kind, tags, story) for story_part in story_parts]
+
+  # uniform_verdicts: the project's UniformVerdicts, when already known
+  def uniform_rule(story, uniform_verdicts=None):
+    if uniform_verdicts is None:
+      uniform_verdicts = UniformVerdicts(story.project.format)
     chunks = []
-    for chunk in ['role', 'means', 'ends']:
+    for chunk in CHUNKS:
       chunks += [Analyzer.extract_indicator_phrases(getattr(story,chunk), chunk)]
     chunks = list(filter(None, chunks))
     chunks = [c.strip() for c in chunks]
     result = False
     if len(chunks) == 1: result = True
     for x in range(0,len(chunks)):
-      if nltk.metrics.distance.edit_distance(chunks[x].lower(), project_format[x].lower()) > 3:
+      if uniform_verdicts.deviates(x, chunks[x]):
         result = True 
     return result
 
-  def well_formed_content_highlight(story_part, kind):
-    return str(Analyzer.content_chunk(story_part, kind))
+  def well_formed_content_highlight(story_part, kind, story=None):
+    return str(Analyzer.content_chunk(story_part, kind, story))
 
-  def content_chunk(chunk, kind):
-    sentence = AQUSATagger.parse(chunk)[0]
+  # story: the story the chunk was taken from, whose title tagging it is
+  # sliced from when the title has been planned
+  def content_tags(chunk, kind, story=None):
+    sentence = AQUSATagger.parse(chunk, story.title if story else None)[0]
     sentence = Analyzer.strip_indicators_pos(chunk, sentence, kind)
-    sentence = Analyzer.replace_tag_of_special_words(sentence)
-    cp = nltk.RegexpParser(CHUNK_GRAMMAR)
-    result = cp.parse(sentence)
-    return result
+    return Analyzer.replace_tag_of_special_words(sentence)
+
+  def content_chunk(chunk, kind, story=None):
+    return CHUNKER.parse(Analyzer.content_tags(chunk, kind, story))
 
   def replace_tag_of_special_words(sentence):
     index = 0
@@ -386,39 +1159,38 @@ class Analyzer:
     return sentence
 
   def extract_indicator_phrases(text, indicator_type):
-    if text:
-      indicator_phrase = []
-      for indicator in eval(indicator_type.upper() + '_INDICATORS'):
-        if re.compile('(%s)' % indicator.lower().replace('[, ]', '')).search(text.lower()): indicator_phrase += [indicator.replace('^', '').replace('[, ]', '')]
-      return max(indicator_phrase, key=len) if indicator_phrase else None
-    else:
-      return text
+    return INDICATORS.extract(text, indicator_type)
 
   def strip_indicators_pos(text, pos_text, indicator_type):
-    for indicator in eval(indicator_type.upper() + '_INDICATORS'):
-      if indicator.lower().strip() in text.lower():
-        indicator_words = nltk.word_tokenize(indicator)
-        pos_text = [x for x in pos_text if x[0] not in indicator_words]
+    import nltk
+    for indicator in INDICATORS.contained(text, indicator_type):
+      indicator_words = nltk.word_tokenize(indicator)
+      pos_text = [x for x in pos_text if x[0] not in indicator_words]
     return pos_text
 
 
+# Whether an indicator phrase strays from the project format, by the
+# phrase's position among the story's phrases. Projects use only a handful
+# of distinct phrases, so each edit distance is computed once and then
+# looked up for every further story.
+class UniformVerdicts(object):
+  def __init__(self, project_format):
+    self.format = project_format.split(',')
+    self.verdicts = {}
+
+  def deviates(self, position, phrase):
+    key = (position, phrase.lower())
+    if key not in self.verdicts:
+      from nltk.metrics.distance import edit_distance
+      self.verdicts[key] = edit_distance(key[1], self.format[position].lower()) > 3
+    return self.verdicts[key]
+
 class WellFormedAnalyzer:
-  def well_formed(story):
-    WellFormedAnalyzer.means(story)
-    WellFormedAnalyzer.role(story)
-    # WellFormedAnalyzer.means_comma(story)
-    # WellFormedAnalyzer.ends_comma(story)
-    # return story
-
-  def means(story):
-    if not story.means:
-      Defects.create_unless_duplicate('Add what you want to achieve', 'well_formed', 'no_means', 'high', story )
-    return story
+  def no_means(story):
+    return not story.means
 
-  def role(story):
-    if not story.role:
-      Defects.create_unless_duplicate('Add for who this story is', 'well_formed', 'no_role', 'high', story )
-    return story
+  def no_role(story):
+    return not story.role
 
   # def ends(story):
   #   if not story.ends:
@@ -440,17 +1212,8 @@ class WellFormedAnalyzer:
     return story
 
 class MinimalAnalyzer:
-  def minimal(story):
-    MinimalAnalyzer.punctuation(story)
-    MinimalAnalyzer.brackets(story)
-    MinimalAnalyzer.indicator_repetition(story)
-    return story
-
   def punctuation(story):
-    if any(re.compile('(\%s .)' % x).search(story.title.lower()) for x in PUNCTUATION):
-      highlight = MinimalAnalyzer.punctuation_highlight(story, 'high')
-      Defects.create_unless_duplicate(highlight, 'minimal', 'punctuation', 'high', story )
-    return story
+    return any(re.compile('(\%s .)' % x).search(story.title.lower()) for x in PUNCTUATION)
 
   def punctuation_highlight(story, severity):
     highlighted_text = story.title
@@ -462,10 +1225,7 @@ class MinimalAnalyzer:
     return highlighted_text
 
   def brackets(story):
-    if any(re.compile('(\%s' % x[0] + '.*\%s(\W|\Z))' % x[1]).search(story.title.lower()) for x in BRACKETS):
-      highlight = MinimalAnalyzer.brackets_highlight(story, 'high')
-      Defects.create_unless_duplicate(highlight, 'minimal', 'brackets', 'high', story )
-    return story.defects.all()
+    return any(re.compile('(\%s' % x[0] + '.*\%s(\W|\Z))' % x[1]).search(story.title.lower()) for x in BRACKETS)
 
   def brackets_highlight(story, severity):
     highlighted_text = story.title
@@ -486,15 +1246,14 @@ class MinimalAnalyzer:
       highlighted_text = highlighted_text[:index[0]] + "<span class='highlight-text severity-" +  severity + "'>" + word + "</span>" + highlighted_text[index[1]:]
     return highlighted_text
 
-  def indicator_repetition(story):
+  # the indicator hits of the story per chunk kind
+  def repeated_indicators(story):
     indicators = StoryChunker.detect_all_indicators(story)
     for indicator in indicators: indicators[indicator] = StoryChunker.remove_overlapping_tuples(indicators[indicator])
-    indicators = MinimalAnalyzer.remove_indicator_repetition_exceptions(indicators, story)
-    for indicator in indicators:
-      if len(indicators[indicator]) >= 2:
-        highlight = MinimalAnalyzer.indicator_repetition_highlight(story.title, indicators[indicator], 'high')
-        Defects.create_unless_duplicate(highlight, 'minimal', 'indicator_repetition', 'high', story)
-    return story
+    return MinimalAnalyzer.remove_indicator_repetition_exceptions(indicators, story)
+
+  def indicator_repetition(story, chunk):
+    return len(MinimalAnalyzer.repeated_indicators(story)[chunk]) >= 2
   
   def indicator_repetition_highlight(text, ranges, severity):
     indices = []
@@ -514,52 +1273,75 @@ class MinimalAnalyzer:
 
 class StoryChunker:
   def chunk_story(story):
-    StoryChunker.chunk_on_indicators(story)
-    if story.means is None:
-      potential_means = story.title
-      if story.role is not None:
-        potential_means = potential_means.replace(story.role, "", 1).strip()
-      if story.ends is not None:
-        potential_means = potential_means.replace(story.ends, "", 1).strip()
-      StoryChunker.means_tags_present(story, potential_means)
+    StoryChunker.chunk_stories([story])
     return story.role, story.means, story.ends
 
-  def chunk_on_indicators(story):
+  # chunks many stories per stage, so every stage tags its texts in bulk.
+  # The titles are tagged once and the texts within them sliced from that.
+  def chunk_stories(stories):
+    titles = [story.title for story in stories]
+    with AQUSATagger.plan(titles):
+      with AQUSATagger.batch([StoryChunker.text_after_role(story) for story in stories], titles):
+        for story in stories:
+          StoryChunker.chunk_on_indicators(story)
+      without_means = [story for story in stories if story.means is None]
+      with AQUSATagger.batch([StoryChunker.potential_means(story) for story in without_means], [story.title for story in without_means]):
+        for story in without_means:
+          StoryChunker.means_tags_present(story, StoryChunker.potential_means(story))
+    return stories
+
+  def potential_means(story):
+    potential_means = story.title
+    if story.role is not None:
+      potential_means = potential_means.replace(story.role, "", 1).strip()
+    if story.ends is not None:
+      potential_means = potential_means.replace(story.ends, "", 1).strip()
+    return potential_means
+
+  # text that is tagged to find the role of a story without a means
+  def text_after_role(story):
+    indicators = StoryChunker.detect_story_indicators(story)
+    if indicators['role'] is not None and indicators['means'] is None:
+      return StoryChunker.remove_role_indicator(story.title)[1]
+    return None
+
+  def remove_role_indicator(text):
+    role = StoryChunker.detect_indicator_phrase(text, 'role')
+    return role, StoryChunker.remove_special_characters(text).replace(role[1], '')
+
+  def detect_story_indicators(story):
     indicators = StoryChunker.detect_indicators(story)
     if indicators['means'] is not None and indicators['ends'] is not None:
       indicators = StoryChunker.correct_erroneous_indicators(story, indicators)
+    return indicators
+
+  def chunk_on_indicators(story):
+    indicators = StoryChunker.detect_story_indicators(story)
     if indicators['role'] is not None and indicators['means'] is not None:
       story.role = story.title[indicators['role']:indicators['means']].strip()
       story.means = story.title[indicators['means']:indicators['ends']].strip()
     elif indicators['role'] is not None and indicators['means'] is None:
-      role = StoryChunker.detect_indicator_phrase(story.title, 'role')
-      text = StoryChunker.remove_special_characters(story.title)
-      new_text = text.replace(role[1], '')
+      role, new_text = StoryChunker.remove_role_indicator(story.title)
 
-      sentence = Analyzer.content_chunk(new_text, 'role')
+      sentence = Analyzer.content_chunk(new_text, 'role', story)
       NPs_after_role = StoryChunker.keep_if_NP(sentence)
       if NPs_after_role:
         story.role = story.title[indicators['role']:(len(role[1]) + 1 + len(NPs_after_role))].strip()
     if indicators['ends']: story.ends = story.title[indicators['ends']:None].strip()
-    story.save()
     return story
 
   def detect_indicators(story):
     indicators = {'role': None, "means": None, 'ends': None}
+    indicator_phrases = StoryChunker.detect_indicator_phrases(story.title)
+    title = story.title.lower() if story.title else story.title
     for indicator in indicators:
-      indicator_phrase = StoryChunker.detect_indicator_phrase(story.title, indicator)
+      indicator_phrase = indicator_phrases[indicator]
       if indicator_phrase[0]:
-        indicators[indicator.lower()] = story.title.lower().index(indicator_phrase[1].lower())
+        indicators[indicator] = title.index(indicator_phrase[1].lower())
     return indicators
 
   def detect_all_indicators(story):
-    indicators = {'role': [], "means": [], 'ends': []}
-    for indicator in indicators:
-      for indicator_phrase in eval(indicator.upper() + '_INDICATORS'):  
-        if story.title:
-          for indicator_match in re.compile('(%s)' % indicator_phrase.lower()).finditer(story.title.lower()):
-            indicators[indicator] += [indicator_match.span()]
-    return indicators
+    return INDICATORS.spans(story.title)
 
   # get longest from overlapping indicator hits
   def remove_overlapping_tuples(tuple_list):
@@ -577,17 +1359,11 @@ class StoryChunker:
     return ''.join( e if (e.isalnum() or e.isspace() or e == "\'" or e == "\"" ) else ' ' for e in text).strip()
 
   def detect_indicator_phrase(text, indicator_type):
-    result = False
-    detected_indicators = ['']
-    no_special_char_text = StoryChunker.remove_special_characters(text)
-    for indicator_phrase in eval(indicator_type.upper() + '_INDICATORS'):
-      if text:
-        if re.compile('(%s)' % indicator_phrase.lower()).search(no_special_char_text.lower()):
-          stripped_indicator = indicator_phrase.replace('^', '').replace('[, ]', '').strip()
-          if stripped_indicator.lower() in text.lower():
-            result = True
-            detected_indicators.append(stripped_indicator)
-    return (result, max(detected_indicators, key=len))
+    return StoryChunker.detect_indicator_phrases(text)[indicator_type]
+
+  # (found, longest phrase) of every indicator type, from one scan of the text
+  def detect_indicator_phrases(text):
+    return INDICATORS.detect(text, StoryChunker.remove_special_characters(text) if text else text)
 
 
   def keep_if_NP(parsed_tree):
@@ -604,7 +1380,7 @@ class StoryChunker:
     return ' '.join(return_string)
 
   def means_tags_present(story, string):
-    if not Analyzer.well_formed_content_rule(string, 'means', ['MEANS']):
+    if not Analyzer.well_formed_content_rule(string, 'means', ['MEANS'], story):
       story.means = string
       story.save
     return story
@@ -624,7 +1400,7 @@ class StoryChunker:
 class CorrectDefect:
   def correct_minor_issue(defect):
     story = defect.story
-    eval('CorrectDefect.correct_%s(defect)' % defect.subkind)
+    getattr(CorrectDefect, 'correct_%s' % defect.subkind)(defect)
     return story
 
   def correct_no_means_comma(defect):
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+import traceback
+
+# Sends webhook notifications, GETs of a url, on a few background threads
+# sharing one pooled HTTP session, so that a slow receiver does not hold up
+# the caller. A url that is queued and not being sent yet is not queued
+# again, and within coalesce() urls are only queued, once each, when the
+# outermost block exits. Failed deliveries are retried with backoff.
+class Notifier(object):
+
+  def __init__(self, workers=4, retries=3, backoff=0.5, timeout=5):
+    self.workers = workers
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+    self.session = None
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  # requests takes long to import, so the session is made on first use
+  def http(self):
+    with self.lock:
+      if self.session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.session = session
+    return self.session
+
+  # the future of the delivery, or None while coalescing
+  def notify(self, url):
+    buffer = getattr(self.local, 'buffer', None)
+    if buffer is not None:
+      buffer[url] = None
+      return None
+    return self.send(url)
+
+  def send(self, url):
+    with self.lock:
+      if url not in self.pending:
+        self.pending[url] = self.executor.submit(self.deliver, url)
+      return self.pending[url]
+
+  @contextmanager
+  def coalesce(self):
+    if getattr(self.local, 'buffer', None) is not None:
+      yield
+      return
+    self.local.buffer = OrderedDict()
+    try:
+      yield
+    finally:
+      buffer, self.local.buffer = self.local.buffer, None
+      for url in buffer:
+        self.send(url)
+
+  # the status code of the response, or None when every attempt failed;
+  # connection errors, timeouts and 5xx responses are retried
+  def deliver(self, url):
+    import requests
+    with self.lock:
+      self.pending.pop(url, None)
+    for attempt in range(self.retries + 1):
+      if attempt:
+        time.sleep(self.backoff * 2 ** (attempt - 1))
+      try:
+        response = self.http().get(url, timeout=self.timeout)
+        if response.status_code < 500:
+          return response.status_code
+      except requests.RequestException:
+        if attempt == self.retries: traceback.print_exc()
+    return None
+
+  # waits for the queued deliveries
+  def close(self):
+    self.executor.shutdown()
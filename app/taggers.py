@@ -1,61 +1,437 @@
-import nltk
-from nltk.tag.stanford import POSTagger
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
 import time
 import pexpect
 
+TAGGER_MODEL = 'stanford/english-left3words-distsim.tagger'
+TAGGER_CMD = 'java -mx300m -cp stanford/stanford-postagger-withModel.jar edu.stanford.nlp.tagger.maxent.MaxentTagger -model ' + TAGGER_MODEL
+BATCH_SIZE = 50
+# how long a caller waits for an idle tagger before trying to start one again
+CHECKOUT_WAIT = 1
+SENTINEL = 'AQUSASENTINEL'
+SENTINEL_PATTERN = re.compile(r'^%s(\d+)_' % SENTINEL)
+# tokens the tagger's tokenizer writes in place of brackets and quotes
+PTB_ESCAPES = {'-LRB-': '(', '-RRB-': ')', '-LSB-': '[', '-RSB-': ']', '-LCB-': '{', '-RCB-': '}',
+  '``': '"', "''": '"', '`': "'"}
+
+# Talks to the MaxentTagger over its stdin. Every text is followed by a
+# numbered sentinel line, which the tagger echoes back as a single tagged
+# token, so the end of each response is known without polling.
 class StanfordTagger(object):
 
-  def __init__(self):
-    cmd = 'java -mx300m -cp stanford/stanford-postagger-withModel.jar edu.stanford.nlp.tagger.maxent.MaxentTagger -model stanford/english-left3words-distsim.tagger'
-    self.pos_tagger = pexpect.spawn(cmd)
-    self.pos_tagger.expect('done', timeout=20)
+  def __init__(self, cmd=TAGGER_CMD, timeout=20):
+    self.frames = itertools.count()
+    self.failed = False
+    self.lines = queue.Queue()
+    self.lock = threading.Lock()
+    self.pos_tagger = pexpect.spawn(cmd, timeout=None)
+    self.pos_tagger.setecho(False)
+    self.pos_tagger.delaybeforesend = 0
+    self.pos_tagger.expect('done', timeout=timeout)
+    self.reader = threading.Thread(target=self._read)
+    self.reader.daemon = True
+    self.reader.start()
+    # discards whatever the tagger printed after loading its model
+    self.parse_batch([''])
     print('Initialized StanfordTagger')
 
-  def _parse(self, text):
-    # clean up any leftover results
+  def _read(self):
     while True:
       try:
-          self.pos_tagger.read_nonblocking(4000, 0.25)
-      except pexpect.TIMEOUT:
-          break
+        line = self.pos_tagger.readline()
+      except (OSError, pexpect.ExceptionPexpect):
+        line = None
+      if not line:
+        self.lines.put(None)
+        break
+      self.lines.put(line.decode('utf-8', 'replace').rstrip('\r\n'))
 
-    # send the actual text
-    self.pos_tagger.sendline(text)
+  def _parse_batch(self, texts):
+    lines = [' '.join(text.split()) for text in texts]
+    frames = [next(self.frames) for line in lines]
+    self.pos_tagger.send(''.join('%s\n%s%d\n' % (line, SENTINEL, frame) for line, frame in zip(lines, frames)))
 
-    max_expected_time = min(40, 3 + len(text) / 20.0)
+    max_expected_time = min(40, 3 + sum(len(line) for line in lines) / 20.0)
     end_time = time.time() + max_expected_time
+    sent_lines = set(lines)
 
-    incoming = ""
-    while True:
-      # Time left, read more data
+    results = []
+    tagged_lines = []
+    while len(results) < len(lines):
       try:
-        incoming += self.pos_tagger.read_nonblocking(2000, 0.5).decode('utf-8')
-        if "_" in incoming: 
-            break
-        time.sleep(0.0001)
-      except pexpect.TIMEOUT:
-        if end_time - time.time() < 0:
-          # logger.error("Error: Timeout with input '%s'" % (incoming))
-          return {'error': "timed out after %f seconds" % max_expected_time}
-        else:
-          continue
-      except pexpect.EOF:
-        break
+        line = self.lines.get(timeout=max(0, end_time - time.time()))
+      except queue.Empty:
+        self.failed = True
+        return results + [{'error': "timed out after %f seconds" % max_expected_time} for line in lines[len(results):]]
+      if line is None:
+        self.lines.put(None)
+        self.failed = True
+        return results + [{'error': "tagger exited"} for line in lines[len(results):]]
+
+      sentinel = SENTINEL_PATTERN.match(line)
+      if sentinel:
+        # sentinels of earlier, timed out requests close stale output
+        index = int(sentinel.group(1)) - frames[0]
+        if index >= len(results):
+          results += [{'error': "no output for text"} for missing in range(len(results), index)]
+          results.append(self.parse_output('\n'.join(tagged_lines)))
+        tagged_lines = []
+      elif line.strip() and line not in sent_lines:
+        tagged_lines.append(line)
+    return results
 
-    tagged_list = list(filter(None, incoming.split('\r\n')))
-    for item in tagged_list:
-      item.replace('_', ' ')
-    tagged_string = [item for item in tagged_list if item not in [text]][0]
-    result = POSTagger.parse_output(POSTagger, tagged_string)
-    return result
+  @property
+  def healthy(self):
+    return not self.failed and self.pos_tagger.isalive()
+
+  def close(self):
+    self.pos_tagger.close(force=True)
+
+  def parse_output(self, text):
+    tagged_sentences = []
+    for tagged_sentence in text.strip().split('\n'):
+      sentence = []
+      for tagged_word in tagged_sentence.strip().split():
+        word_tags = tagged_word.strip().split('_')
+        sentence.append((''.join(word_tags[:-1]), word_tags[-1]))
+      tagged_sentences.append(sentence)
+    return tagged_sentences
 
   def parse(self, text):
-    response = self._parse(text)
+    response = self.parse_batch([text])[0]
     return response
 
+  def parse_batch(self, texts):
+    results = []
+    with self.lock:
+      for start in range(0, len(texts), BATCH_SIZE):
+        results += self._parse_batch(texts[start:start + BATCH_SIZE])
+    return results
+
+# Hands out tagger processes to one caller at a time. Taggers that timed out
+# or exited are replaced by a fresh process the next time they are checked out.
+# Taggers are started when first needed, or ahead of time in the background
+# with prefork; ready is set once all of them are running.
+class TaggerPool(object):
+
+  def __init__(self, size=1, factory=StanfordTagger, prefork=False):
+    self.size = size
+    self.factory = factory
+    self.idle = queue.Queue()
+    self.started = 0
+    self.lock = threading.Lock()
+    self.ready = threading.Event()
+    self.executor = ThreadPoolExecutor(max_workers=size)
+    if prefork:
+      self.prefork()
+
+  def prefork(self):
+    def start_all():
+      try:
+        while self.start():
+          pass
+      except Exception as error:
+        print('Could not start tagger: %s' % error)
+    thread = threading.Thread(target=start_all)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  # starts one more tagger unless all of them are running
+  def start(self):
+    with self.lock:
+      if self.started >= self.size:
+        return False
+      self.started += 1
+    try:
+      tagger = self.factory()
+    except Exception:
+      with self.lock:
+        self.started -= 1
+      raise
+    self.idle.put(tagger)
+    with self.lock:
+      if self.started >= self.size:
+        self.ready.set()
+    return True
+
+  def wait_ready(self, timeout=None):
+    return self.ready.wait(timeout)
+
+  # waits for an idle tagger, starting one if not all of them are running.
+  # A tagger that another thread is starting may fail to start, so waiting
+  # callers try again every CHECKOUT_WAIT seconds; failing to start raises.
+  @contextmanager
+  def checkout(self):
+    tagger = None
+    while tagger is None:
+      try:
+        tagger = self.idle.get_nowait()
+      except queue.Empty:
+        if not self.start():
+          try:
+            tagger = self.idle.get(timeout=CHECKOUT_WAIT)
+          except queue.Empty:
+            pass
+    try:
+      if not tagger.healthy:
+        tagger = self.restart(tagger)
+      yield tagger
+    finally:
+      self.idle.put(tagger)
+
+  def restart(self, tagger):
+    tagger.close()
+    return self.factory()
+
+  def _parse_batch(self, texts):
+    with self.checkout() as tagger:
+      results = tagger.parse_batch(texts)
+    if any(isinstance(result, dict) for result in results):
+      # retry once, on a restarted or another healthy tagger
+      with self.checkout() as tagger:
+        results = tagger.parse_batch(texts)
+    return results
+
+  def parse(self, text):
+    return self.parse_batch([text])[0]
+
+  def parse_batch(self, texts):
+    windows = [texts[start:start + BATCH_SIZE] for start in range(0, len(texts), BATCH_SIZE)]
+    results = []
+    for window in self.executor.map(self._parse_batch, windows):
+      results += window
+    return results
+
+  def close(self):
+    self.executor.shutdown()
+    while not self.idle.empty():
+      self.idle.get().close()
+
+# Bounded LRU of tagger results keyed by text, optionally backed by an SQLite
+# file so results survive restarts. Entries are also keyed by tagger model.
+class TagCache(object):
+
+  def __init__(self, size=20000, path=None, model=TAGGER_MODEL):
+    self.size = size
+    self.model = model
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.store = None
+    if path:
+      if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+      self.store = sqlite3.connect(path, timeout=5, check_same_thread=False)
+      self.store.execute('CREATE TABLE IF NOT EXISTS tags (model TEXT, text TEXT, tagged TEXT, PRIMARY KEY (model, text))')
+      self.store.commit()
+
+  def get(self, text):
+    with self.lock:
+      tagged = self.entries.get(text)
+      if tagged is not None:
+        self.entries.move_to_end(text)
+      elif self.store is not None:
+        tagged = self._load(text)
+        if tagged is not None:
+          self._remember(text, tagged)
+      if tagged is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return tagged
+
+  def put_many(self, items):
+    with self.lock:
+      for text, tagged in items:
+        self._remember(text, tagged)
+      if self.store is not None:
+        try:
+          self.store.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?, ?)',
+            [(self.model, text, json.dumps(tagged)) for text, tagged in items])
+          self.store.commit()
+        except sqlite3.Error:
+          self.store.rollback()
+
+  def put(self, text, tagged):
+    self.put_many([(text, tagged)])
+
+  def _load(self, text):
+    try:
+      row = self.store.execute('SELECT tagged FROM tags WHERE model = ? AND text = ?', (self.model, text)).fetchone()
+    except sqlite3.Error:
+      return None
+    if row:
+      return [[tuple(word) for word in sentence] for sentence in json.loads(row[0])]
+
+  def _remember(self, text, tagged):
+    self.entries[text] = tagged
+    self.entries.move_to_end(text)
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+# Answers from the cache and only sends texts it has not seen to the tagger.
+class CachingTagger(object):
+
+  def __init__(self, tagger, cache):
+    self.tagger = tagger
+    self.cache = cache
+
+  def parse(self, text):
+    return self.parse_batch([text])[0]
+
+  def parse_batch(self, texts):
+    results = [self.cache.get(text) for text in texts]
+    missing = list(OrderedDict.fromkeys(text for text, result in zip(texts, results) if result is None))
+    if missing:
+      tagged = dict(zip(missing, self.tagger.parse_batch(missing)))
+      self.cache.put_many([(text, result) for text, result in tagged.items() if not isinstance(result, dict)])
+      results = [tagged[text] if result is None else result for text, result in zip(texts, results)]
+    return results
+
 class NLTKTagger(object):
   def parse(self, text):
+    import nltk
     sentences = nltk.sent_tokenize(text)
     sentences = [nltk.word_tokenize(sent) for sent in sentences]
     sentences = [nltk.pos_tag(sent) for sent in sentences]
     return sentences
+
+  def parse_batch(self, texts):
+    return [self.parse(text) for text in texts]
+
+# The tagging of a whole text, with the character offsets of its tokens, so
+# that the tagging of any span made of whole tokens is a slice of it.
+class TaggingPlan(object):
+
+  def __init__(self, text, tagged):
+    self.text = text
+    self.tokens = []
+    self.aligned = self.align(tagged)
+
+  # (start, end, sentence, (word, tag)) of every token, found in order with
+  # only whitespace between them; False when a token cannot be found
+  def align(self, tagged):
+    if isinstance(tagged, dict):
+      return False
+    cursor = 0
+    for sentence, words in enumerate(tagged):
+      for word, tag in words:
+        for surface in (PTB_ESCAPES.get(word), word):
+          start = self.text.find(surface, cursor) if surface else -1
+          if start >= 0 and not self.text[cursor:start].strip():
+            break
+        else:
+          return False
+        cursor = start + len(surface)
+        self.tokens.append((start, cursor, sentence, (word, tag)))
+    return not self.text[cursor:].strip()
+
+  # the tagging of text as found in the planned text, split into the same
+  # sentences, or None when text does not cover whole tokens of it
+  def slice(self, text):
+    if not self.aligned or not text or not text.strip():
+      return None
+    start = self.text.find(text.strip())
+    if start < 0:
+      return None
+    end = start + len(text.strip())
+    sentences = OrderedDict()
+    for token_start, token_end, sentence, word in self.tokens:
+      if token_start < end and token_end > start:
+        if token_start < start or token_end > end:
+          return None
+        sentences.setdefault(sentence, []).append(word)
+    return list(sentences.values()) or None
+
+# Serves texts that were tagged up front in bulk, so callers that tag one
+# chunk at a time do not each pay for a round-trip to the tagger. Texts
+# that lie within a planned title are sliced from its tagging instead.
+# Prefetched texts and plans are kept per thread, so that a thread leaving
+# its block does not drop what another thread, e.g. another analysis job
+# with the same titles, still uses.
+class BatchingTagger(object):
+
+  def __init__(self, tagger):
+    self.tagger = tagger
+    self.local = threading.local()
+
+  @property
+  def tagged(self):
+    if not hasattr(self.local, 'tagged'):
+      self.local.tagged = {}
+    return self.local.tagged
+
+  @property
+  def plans(self):
+    if not hasattr(self.local, 'plans'):
+      self.local.plans = {}
+    return self.local.plans
+
+  def prefetch(self, texts):
+    missing, seen = [], set()
+    for text in texts:
+      if text and text not in self.tagged and text not in seen:
+        missing.append(text)
+        seen.add(text)
+    for text, result in zip(missing, self.tagger.parse_batch(missing)):
+      if not isinstance(result, dict):
+        self.tagged[text] = result
+    return [text for text in missing if text in self.tagged]
+
+  # within: for every text, the planned title it was taken from, if any.
+  # Texts that can be sliced from their title's plan are not tagged.
+  @contextmanager
+  def batch(self, texts, within=None):
+    if within is not None:
+      texts = [text for text, title in zip(texts, within) if self.slice(text, title) is None]
+    prefetched = self.prefetch(texts)
+    try:
+      yield self
+    finally:
+      for text in prefetched:
+        self.tagged.pop(text, None)
+
+  # tags every title once, for the duration of the block
+  @contextmanager
+  def plan(self, titles):
+    planned = []
+    missing = list(OrderedDict.fromkeys(title for title in titles if title and title not in self.plans))
+    if missing:
+      for title, tagged in zip(missing, self.tagger.parse_batch(missing)):
+        self.plans[title] = TaggingPlan(title, tagged)
+        planned.append(title)
+    try:
+      yield self
+    finally:
+      for title in planned:
+        self.plans.pop(title, None)
+
+  def slice(self, text, within):
+    plan = self.plans.get(within) if within else None
+    return plan.slice(text) if plan else None
+
+  # within: the planned title the text was taken from, if any
+  def parse(self, text, within=None):
+    sliced = self.slice(text, within)
+    if sliced is not None:
+      return sliced
+    if text in self.tagged:
+      return self.tagged[text]
+    return self.tagger.parse(text)
+
+  def parse_batch(self, texts):
+    with self.batch(texts):
+      return [self.parse(text) for text in texts]
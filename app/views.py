@@ -1,11 +1,13 @@
-from flask import jsonify, abort, session, render_template, request, flash, redirect, url_for, g
+from flask import jsonify, abort, session, render_template, request, flash, redirect, url_for, g, Response, stream_with_context
 from werkzeug import secure_filename
 import os
 from app import app, babel
-from .models import Stories, Projects, Defects
+from .models import Stories, Projects, Defects, Jobs
+from .jobs import JobQueue, wait_for
 from config import LANGUAGES
 import json
-import time
+
+AnalysisJobs = JobQueue(app.config['ANALYSIS_WORKERS'], context=app.app_context, store=Jobs.store)
 
 @app.route('/')
 def index():
@@ -25,10 +27,11 @@ def upload_file(project_unique):
     if file and allowed_file(file.filename):
       filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
       file.save(filepath)
-      for story in project.stories.order_by('id').all():
-        story.delete()
-      project.process_csv(filepath)
-      return redirect(url_for('project', project_unique=project_unique))
+      project.delete_stories()
+      project.process_csv(filepath, analyze=False)
+      job = AnalysisJobs.submit('analyze_project', analyze_project_job(project.id))
+      flash('The stories are being analyzed, see %s' % url_for('job_status', job_id=job.id))
+      return redirect(url_for('project', project_unique=project_unique, job=job.id))
   return render_template('upload_file.html', title='Upload File', project=project)
 
 @app.route('/projects/new', methods=['GET', 'POST'])
@@ -47,17 +50,69 @@ def defect_report():
 @app.route('/project/<string:project_unique>', methods=['GET'])
 def project(project_unique):
   project = Projects.query.get(project_unique)
-  project_defects = project.defects.filter_by(false_positive=False).all()
-  severe_defects = project.defects.filter_by(severity="high", false_positive=False).all()
-  medium_defects = project.defects.filter_by(severity="medium", false_positive=False).all()
-  minor_defects = project.defects.filter_by(severity="minor", false_positive=False).all()
-  false_positives = project.defects.filter_by(false_positive=True).all()
-  perfect_stories = project.stories.filter(Stories.defects == None).all()
-  stories = project.stories.order_by('id').all()
-
-  return render_template('report.html', title=project.name, project=project, 
-    stories=stories, severe_defects=severe_defects, medium_defects=medium_defects, minor_defects=minor_defects, 
-    false_positives=false_positives, perfect_stories=perfect_stories, project_defects=project_defects)
+  counts = project.report_summary()
+  stories, defects, next_after = project.report_page(after=request.args.get('after', 0, type=int),
+    perfect=request.args.get('perfect_stories') == 'True', false_positive=request.args.get('false_positive') == 'True',
+    severity=request.args.get('severity'))
+  next_page = None
+  if next_after is not None:
+    args = request.args.to_dict()
+    args['after'] = next_after
+    next_page = url_for('project', project_unique=project.id, **args)
+
+  return render_template('report.html', title=project.name, project=project, counts=counts,
+    stories=stories, defects=defects, next_page=next_page)
+
+# the stories with their defects as JSON lines, sent while they are read;
+# after resumes an export after the last story id received
+@app.route('/project/<string:project_unique>/stories', methods=['GET'])
+def project_stories(project_unique):
+  project = Projects.query.get(project_unique)
+  if project is None: abort(404)
+  stories = project.export_stories(after=request.args.get('after', 0, type=int))
+  return Response(stream_with_context(json.dumps(story) + '\n' for story in stories), mimetype='application/x-ndjson')
+
+def valid_story(story):
+  return isinstance(story, dict) and isinstance(story.get('title'), str) and story['title'].strip() != '' \
+    and isinstance(story.get('external_id'), int) and not isinstance(story['external_id'], bool)
+
+def submit_stories_job(project_unique, story_ids, changed, titles):
+  def run(job):
+    project = Projects.query.get(project_unique)
+    job.progress('analyze', 0, len(story_ids))
+    stories = project.analyze_submitted(story_ids, changed, titles)
+    job.progress('analyze', len(story_ids), len(story_ids))
+    return stories
+  return run
+
+# a JSON array of stories with an external_id and a title: adds new stories,
+# retitles known ones, and analyzes what changed. Responds with every story
+# and its defects, or with a job that has them as its result when more than
+# BULK_SYNC_LIMIT stories are submitted.
+@app.route('/project/<string:project_unique>/stories', methods=['POST'])
+def submit_stories(project_unique):
+  project = Projects.query.get(project_unique)
+  if project is None: abort(404)
+  stories = request.get_json(silent=True)
+  if not isinstance(stories, list) or not all(valid_story(story) for story in stories): abort(400)
+  story_ids, changed, titles = project.upsert_stories(stories)
+  if len(story_ids) > app.config['BULK_SYNC_LIMIT']:
+    return job_accepted(AnalysisJobs.submit('submit_stories', submit_stories_job(project.id, story_ids, changed, titles)))
+  return jsonify({'success': True, 'stories': project.analyze_submitted(story_ids, changed, titles)}), 200
+
+# the report counts and every story with its defects as one JSON document,
+# streamed like project_stories
+@app.route('/project/<string:project_unique>/report', methods=['GET'])
+def project_report(project_unique):
+  project = Projects.query.get(project_unique)
+  if project is None: abort(404)
+  head = {'id': project.id, 'name': project.name, 'external_id': project.external_id, 'format': project.format}
+  def document(counts):
+    yield '{"project": %s, "counts": %s, "stories": [' % (json.dumps(head), json.dumps(counts))
+    for index, story in enumerate(project.export_stories()):
+      yield (', ' if index else '') + json.dumps(story)
+    yield ']}\n'
+  return Response(stream_with_context(document(project.report_summary())), mimetype='application/json')
 
 @app.route('/project/<string:project_unique>/defect/<int:defect_id>', methods=['POST'])
 def update_defect(project_unique, defect_id):
@@ -67,45 +122,66 @@ def update_defect(project_unique, defect_id):
     defect.false_positive = request.form['false_positive']
     defect.save()
   if request.form.get('correct_minor_issue', None) == 'True':
+    story = defect.story
+    old_title = story.title
     defect.correct_minor_issue()
-    defect.story.re_chunk()
-    defect.story.re_analyze()
+    story.re_analyze(old_title)
   return redirect(url_for('project', project_unique=project.id))
 
 @app.route('/project/<string:project_unique>/stories/update_story', methods=['POST'])
 def update_story(project_unique):
   project = Projects.query.get(project_unique)
   story = project.stories.filter_by(id=request.form['id'])[0]
+  old_title = story.title
   story.title = request.form['value']
   story.save()
-  story.re_chunk()
-  story.re_analyze()
+  story.re_analyze(old_title)
   return story.title
 
 @app.route('/project/<string:project_unique>/correct_minor_issues', methods=['POST'])
 def correct_minor_issues(project_unique):
   project = Projects.query.get(project_unique)
+  story_ids, titles = [], []
   for defect in project.defects.filter_by(severity='minor').all():
+    story_ids.append(defect.story_id)
+    titles.append(defect.story.title)
     defect.correct_minor_issue()
-  project.analyze()
+  project.re_analyze(story_ids, titles)
   return redirect(url_for('project', project_unique=project.id))
 
+def job_accepted(job):
+  return jsonify({'success': True, 'job': job.serialize()}), 202, {'Location': url_for('job_status', job_id=job.id)}
+
+# the project or story may belong to a request that has not committed yet
+def analyze_project_job(project_unique):
+  def run(job):
+    project = wait_for(lambda: Projects.query.get(project_unique))
+    project.analyze(progress=job.progress)
+  return run
+
+def analyze_story_job(project_unique, story_unique):
+  def run(job):
+    story = wait_for(lambda: Stories.query.filter_by(id=story_unique, project_id=project_unique).first())
+    story.re_chunk()
+    story.analyze()
+    job.progress('analyze', 1, 1)
+  return run
+
 @app.route('/project/<string:project_unique>/analyze', methods=['GET'])
 def analyze_project(project_unique):
-  project = Projects.query.get(project_unique)
-  if project == None: time.sleep(2)
-  project.analyze()
-
-  return jsonify({'success': True}), 200
+  job = AnalysisJobs.submit('analyze_project', analyze_project_job(project_unique))
+  return job_accepted(job)
 
 @app.route('/project/<string:project_unique>/stories/<string:story_unique>/analyze', methods=['GET'])
 def analyze_story(project_unique, story_unique):
-  project = Projects.query.get(project_unique)
-  if project == None: time.sleep(2)
-  story = project.stories.filter_by(id=story_unique).first()
-  story.re_chunk()
-  story.analyze()
-  return jsonify({'success': True}), 200
+  job = AnalysisJobs.submit('analyze_story', analyze_story_job(project_unique, story_unique))
+  return job_accepted(job)
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def job_status(job_id):
+  job = AnalysisJobs.get(job_id) or Jobs.query.get(job_id)
+  if job is None: abort(404)
+  return jsonify({'job': job.serialize()}), 200
 
 
 # @app.route('/backend/api/v1.0/stories', methods=['POST'])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Compares the single-scan IndicatorEngine with the per-indicator regex
+# search it replaced, on a generated corpus of user stories.
+#
+#   python benchmarks/bench_indicators.py [stories]
+#
+# Run from the repository root in the app environment (DATABASE_URL set).
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.indicators import IndicatorEngine
+from app.models import ROLE_INDICATORS, MEANS_INDICATORS, ENDS_INDICATORS, StoryChunker
+INDICATORS = {'role': ROLE_INDICATORS, 'means': MEANS_INDICATORS, 'ends': ENDS_INDICATORS}
+remove_special_characters = StoryChunker.remove_special_characters
+
+ROLES = ["As a visitor", "As an administrator", "As a registered user", "As the product owner", "Visitor"]
+MEANS = ["I want to browse the catalogue", "I am able to export all orders", "I can upload a CSV file", "I want the dashboard to load fast"]
+ENDS = ["so that I can compare prices", "in order to save time", "so I know what happened", ""]
+
+# the search every call site did before the engine existed
+def legacy(title):
+  detected, spans = {}, {}
+  for kind, indicators in INDICATORS.items():
+    found, phrases, spans[kind] = False, [''], []
+    for indicator in indicators:
+      if re.compile('(%s)' % indicator.lower()).search(remove_special_characters(title).lower()):
+        stripped = indicator.replace('^', '').replace('[, ]', '').strip()
+        if stripped.lower() in title.lower():
+          found = True
+          phrases.append(stripped)
+      for match in re.compile('(%s)' % indicator.lower()).finditer(title.lower()):
+        spans[kind] += [match.span()]
+    detected[kind] = (found, max(phrases, key=len))
+  return detected, spans
+
+def engine(title, indicator_engine):
+  return indicator_engine.detect(title, remove_special_characters(title)), indicator_engine.spans(title)
+
+def main(stories=20000):
+  random.seed(0)
+  corpus = ['%s, %s, %s' % (random.choice(ROLES), random.choice(MEANS), random.choice(ENDS)) for index in range(stories)]
+  indicator_engine = IndicatorEngine(INDICATORS)
+
+  start = time.time()
+  expected = [legacy(title) for title in corpus]
+  legacy_time = time.time() - start
+
+  start = time.time()
+  results = [engine(title, indicator_engine) for title in corpus]
+  engine_time = time.time() - start
+
+  assert results == expected
+  print('legacy: %.3f s, engine: %.3f s, speedup %.1fx over %d stories' % (legacy_time, engine_time, legacy_time / engine_time, stories))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Startup time regression benchmark: imports the app in fresh interpreters
+# and checks that no heavy module was loaded and no tagger was started.
+#
+#   python benchmarks/bench_startup.py [runs] [max median s]
+#
+# Run from the repository root in the app environment (DATABASE_URL set).
+# Exits with status 1 when the median import time is above the budget or a
+# heavy module was imported.
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HEAVY = ['pandas', 'nltk', 'requests']
+PROBE = """
+import json, sys, time
+start = time.time()
+import app
+from app import models
+print(json.dumps({'seconds': time.time() - start, 'taggers': models.AQUSATagger.tagger.tagger.started,
+  'heavy': [module for module in %r if module in sys.modules]}))
+""" % HEAVY
+
+def main(runs=5, budget=1.0):
+  env = dict(os.environ, TAGGER_PREFORK='0')
+  timings, heavy, taggers = [], set(), 0
+  for run in range(runs):
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT, env=env)
+    probe = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+    timings.append(probe['seconds'])
+    heavy.update(probe['heavy'])
+    taggers = max(taggers, probe['taggers'])
+  timings.sort()
+  median = timings[len(timings) // 2]
+  print('import app: median %.3f s, max %.3f s over %d runs' % (median, timings[-1], runs))
+  print('taggers started: %d, heavy modules imported: %s' % (taggers, ', '.join(sorted(heavy)) or 'none'))
+  return 0 if median <= budget and not heavy and not taggers else 1
+
+if __name__ == '__main__':
+  sys.exit(main(*[cast(arg) for cast, arg in zip([int, float], sys.argv[1:])]))
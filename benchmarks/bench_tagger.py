@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Latency regression benchmark for the tagger subprocess protocol.
+#
+#   python benchmarks/bench_tagger.py [calls] [max median ms]
+#
+# Run from the repository root in the app environment (DATABASE_URL set), with
+# the stanford jar and model in stanford/.
+# Exits with status 1 when the median per-call latency on the warm JVM is
+# above the budget.
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.taggers import StanfordTagger
+
+CHUNKS = ["As a visitor,", "I want to browse the product catalogue,", "so that I can compare prices",
+  "As an administrator,", "I am able to export all orders and invoices"]
+
+def main(calls=500, budget=10.0):
+  tagger = StanfordTagger()
+  for chunk in CHUNKS * 10:
+    tagger.parse(chunk)
+
+  timings = []
+  for index in range(calls):
+    start = time.time()
+    tagger.parse(CHUNKS[index % len(CHUNKS)])
+    timings.append((time.time() - start) * 1000)
+  timings.sort()
+
+  start = time.time()
+  tagger.parse_batch(CHUNKS * (calls // len(CHUNKS)))
+  batch_time = (time.time() - start) * 1000
+  tagger.close()
+
+  median = timings[len(timings) // 2]
+  print('parse: median %.2f ms, p95 %.2f ms over %d calls' % (median, timings[int(len(timings) * 0.95)], calls))
+  print('parse_batch: %.2f ms per text' % (batch_time / calls))
+  return 0 if median <= budget else 1
+
+if __name__ == '__main__':
+  sys.exit(main(*[cast(arg) for cast, arg in zip([int, float], sys.argv[1:])]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Counts the texts sent to the tagger per story while chunking a generated
+# corpus and running the atomic rule on it, with and without tagging each
+# title once and slicing its chunks from that tagging.
+#
+#   python benchmarks/bench_tagging_plan.py [stories]
+#
+# Run from the repository root in the app environment (DATABASE_URL set), with
+# the stanford jar and model in stanford/.
+import os
+import random
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import models
+from app.models import Stories, StoryChunker, Analyzer, CHUNKS
+from app.taggers import StanfordTagger, BatchingTagger
+
+ROLES = ["As a visitor", "As an administrator", "As a registered user and buyer", "As the product owner"]
+MEANS = ["I want to browse the catalogue and compare products", "I am able to export all orders", "I can upload a CSV file or an Excel sheet", "I want the dashboard to load fast"]
+ENDS = ["so that I can compare prices", "in order to save time", "so I know what happened"]
+
+class CountingTagger(object):
+  def __init__(self, tagger):
+    self.tagger = tagger
+    self.texts = 0
+
+  def parse(self, text):
+    self.texts += 1
+    return self.tagger.parse(text)
+
+  def parse_batch(self, texts):
+    self.texts += len(texts)
+    return self.tagger.parse_batch(texts)
+
+# the tagger as it was before titles were planned
+class UnplannedTagger(BatchingTagger):
+  @contextmanager
+  def plan(self, titles):
+    yield self
+
+def run(titles, batching, tagger):
+  models.AQUSATagger = batching(CountingTagger(tagger))
+  stories = [Stories(title=title) for title in titles]
+  start = time.time()
+  StoryChunker.chunk_stories(stories)
+  with Analyzer.tagging(stories):
+    for story in stories:
+      for chunk in CHUNKS:
+        Analyzer.atomic_rule(getattr(story, chunk), chunk, story)
+  return models.AQUSATagger.tagger.texts / float(len(stories)), time.time() - start
+
+def main(count=500):
+  random.seed(1)
+  titles = ['%s, %s, %s' % (random.choice(ROLES), random.choice(MEANS), random.choice(ENDS)) + ' #%d' % index for index in range(count)]
+  tagger = StanfordTagger()
+  before, before_time = run(titles, UnplannedTagger, tagger)
+  after, after_time = run(titles, BatchingTagger, tagger)
+  tagger.close()
+  print('without plans: %.2f texts tagged per story, %.2f s' % (before, before_time))
+  print('with plans:    %.2f texts tagged per story, %.2f s' % (after, after_time))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
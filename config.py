@@ -2,6 +2,28 @@ import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 WTF_CSRF_ENABLED=True
 UPLOAD_FOLDER= os.path.join(basedir,"tmp")
+TAGGER_POOL_SIZE = int(os.environ.get('TAGGER_POOL_SIZE', 2))
+# start the taggers in the background when the app loads instead of on first use
+TAGGER_PREFORK = os.environ.get('TAGGER_PREFORK', '0') not in ('', '0', 'false')
+ANALYSIS_WINDOW = int(os.environ.get('ANALYSIS_WINDOW', 500))
+ANALYSIS_PROCESSES = int(os.environ.get('ANALYSIS_PROCESSES', 1))
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 2))
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+# stories per page of the project report
+REPORT_PAGE_SIZE = int(os.environ.get('REPORT_PAGE_SIZE', 100))
+# larger story submissions are analyzed in a background job
+BULK_SYNC_LIMIT = int(os.environ.get('BULK_SYNC_LIMIT', 200))
+# defect comment webhooks: concurrent deliveries, retries of a failed one,
+# seconds before the first retry (doubling after each) and request timeout
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))
+NOTIFY_RETRIES = int(os.environ.get('NOTIFY_RETRIES', 3))
+NOTIFY_BACKOFF = float(os.environ.get('NOTIFY_BACKOFF', 0.5))
+NOTIFY_TIMEOUT = float(os.environ.get('NOTIFY_TIMEOUT', 5))
+# stories read per query while streaming a project's stories
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+TAG_CACHE_SIZE = int(os.environ.get('TAG_CACHE_SIZE', 20000))
+TAG_CACHE_PATH = os.environ.get('TAG_CACHE_PATH', os.path.join(basedir, "tmp", "tag_cache.sqlite"))
+LEXICON_PATH = os.environ.get('LEXICON_PATH', os.path.join(basedir, "lexicon", "wordnet.tsv"))
 LANGUAGES = {
   'ma': 'Machine',
   'en': 'English'
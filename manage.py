@@ -19,5 +19,11 @@ def translate():
 
 manager.add_command('translate', translate())
 
+@manager.command
+def build_lexicon():
+  "Builds the WordNet lexicon used by the conjunction exception check"
+  from app.lexicon import Lexicon
+  print('Wrote ' + Lexicon.from_wordnet(app.config['LEXICON_PATH']))
+
 if __name__ == '__main__':
   manager.run()
\ No newline at end of file
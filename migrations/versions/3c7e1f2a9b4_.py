@@ -0,0 +1,22 @@
+"""add stories analysis_hash
+
+Revision ID: 3c7e1f2a9b4
+Revises: 25253238bc5
+Create Date: 2026-10-18 13:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c7e1f2a9b4'
+down_revision = '25253238bc5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('stories', sa.Column('analysis_hash', sa.String(length=40), nullable=True))
+
+
+def downgrade():
+    op.drop_column('stories', 'analysis_hash')
@@ -0,0 +1,32 @@
+"""add format_counts
+
+Revision ID: 4d2b8e6c1a7
+Revises: 3c7e1f2a9b4
+Create Date: 2026-10-18 13:30:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d2b8e6c1a7'
+down_revision = '3c7e1f2a9b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('format_counts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('chunk', sa.String(length=20), nullable=False),
+    sa.Column('phrase', sa.Text(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_format_counts_lookup', 'format_counts', ['project_id', 'chunk', 'count'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_format_counts_lookup', 'format_counts')
+    op.drop_table('format_counts')
@@ -0,0 +1,36 @@
+"""add report_summaries and projects.report_version
+
+Revision ID: 5e8a3f1d2c6
+Revises: 4d2b8e6c1a7
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e8a3f1d2c6'
+down_revision = '4d2b8e6c1a7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('projects', sa.Column('report_version', sa.Integer(), server_default='0', nullable=False))
+    op.create_table('report_summaries',
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('stories', sa.Integer(), nullable=False),
+    sa.Column('perfect', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('high', sa.Integer(), nullable=False),
+    sa.Column('medium', sa.Integer(), nullable=False),
+    sa.Column('minor', sa.Integer(), nullable=False),
+    sa.Column('false_positives', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ),
+    sa.PrimaryKeyConstraint('project_id')
+    )
+
+
+def downgrade():
+    op.drop_table('report_summaries')
+    op.drop_column('projects', 'report_version')
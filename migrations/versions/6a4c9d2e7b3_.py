@@ -0,0 +1,32 @@
+"""add title and defect key hashes with their indexes
+
+Revision ID: 6a4c9d2e7b3
+Revises: 5e8a3f1d2c6
+Create Date: 2026-10-18 16:20:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a4c9d2e7b3'
+down_revision = '5e8a3f1d2c6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('stories', sa.Column('title_hash', sa.String(length=32), nullable=True))
+    op.add_column('defects', sa.Column('key_hash', sa.String(length=32), nullable=True))
+    # the same digests as Stories.title_digest and Defects.key_digest, on a
+    # UTF8 database
+    op.execute("UPDATE stories SET title_hash = md5(title) WHERE title IS NOT NULL")
+    op.execute("UPDATE defects SET key_hash = md5(kind || E'\\n' || subkind || E'\\n' || severity || E'\\n' || highlight)")
+    op.create_index('ix_stories_title_hash', 'stories', ['project_id', 'title_hash'], unique=False)
+    op.create_index('ix_defects_key_hash', 'defects', ['story_id', 'key_hash', 'false_positive'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_defects_key_hash', 'defects')
+    op.drop_index('ix_stories_title_hash', 'stories')
+    op.drop_column('defects', 'key_hash')
+    op.drop_column('stories', 'title_hash')
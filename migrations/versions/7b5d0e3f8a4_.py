@@ -0,0 +1,27 @@
+"""recount format_counts and make its phrases unique
+
+Revision ID: 7b5d0e3f8a4
+Revises: 6a4c9d2e7b3
+Create Date: 2026-10-18 18:05:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b5d0e3f8a4'
+down_revision = '6a4c9d2e7b3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # projects from before format_counts only hold the deltas of later edits,
+    # so every project is counted again from its stories on first use
+    op.execute("DELETE FROM format_counts")
+    op.add_column('projects', sa.Column('format_counted', sa.Boolean(), server_default='false', nullable=False))
+    op.create_unique_constraint('uq_format_counts_phrase', 'format_counts', ['project_id', 'chunk', 'phrase'])
+
+
+def downgrade():
+    op.drop_constraint('uq_format_counts_phrase', 'format_counts', type_='unique')
+    op.drop_column('projects', 'format_counted')
@@ -1,4 +1,7 @@
 #!/usr/bin/env python
 
 from app import app
-app.run(debug=True)
\ No newline at end of file
+
+# ParallelAnalyzer's spawned workers import this module too
+if __name__ == '__main__':
+  app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# Stands in for the MaxentTagger in tests. Every word is tagged NN unless the
+# input gives its tag as word/TAG. A line containing EXIT ends the process.
+import sys
+
+print('Loading default properties from tagger fake.tagger ... done [0.0 sec].')
+sys.stdout.flush()
+
+while True:
+  line = sys.stdin.readline()
+  if not line or 'EXIT' in line.split():
+    break
+  tagged = []
+  for word in line.split():
+    word, tag = (word.split('/', 1) + ['NN'])[:2]
+    tagged.append(word + '_' + tag)
+  print(' '.join(tagged))
+  sys.stdout.flush()
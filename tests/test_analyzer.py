@@ -1,9 +1,12 @@
 import os
+import types
 import unittest
 
 from config import basedir
 from app import app, db
-from app.models import Story, Project, Defect
+from app.jobs import JobQueue
+from app.models import Jobs, Stories, Projects, Defects, Analyzer, Rule, RuleRegistry, RULES, UniformVerdicts, ReportSummaries, REPORT_COUNTS, CHUNKS, ANALYSIS_ORDER
+Story, Project, Defect = Stories, Projects, Defects
 
 class TestCase(unittest.TestCase):
   def setUp(self):
@@ -133,6 +136,332 @@ class UniformTests(TestCase):
     assert defect.kind == 'uniform'
     assert defect.severity == 'medium'
 
+class ReAnalyzeTests(TestCase):
+  def setUp(self):
+    TestCase.setUp(self)
+    self.project = new_project()
+    self.stories = [Stories.create(title, None, self.project.id) for title in [
+      "As a User, I want to add a user story, so that I document a requirement",
+      "As a User, I want to delete a user story, so that I clean up the backlog",
+      "As a User, I want to delete a user story, so that I clean up the backlog",
+      "As a User, I want to export a report, so that I share the results"]]
+    self.project.analyze()
+
+  def edit(self, story, title):
+    old_title = story.title
+    story.title = title
+    story.save()
+    return old_title
+
+  def test_unchanged_stories_are_skipped(self):
+    assert self.project.re_analyze() == []
+
+  def test_edited_story(self):
+    story = self.stories[0]
+    old_title = self.edit(story, "As a User, I want to rename a user story, so that I fix typos")
+    assert self.project.re_analyze([story.id], [old_title]) == [story.id]
+    assert story.means.strip() == "I want to rename a user story,"
+
+  def test_stories_sharing_the_old_title(self):
+    story, twin = self.stories[1], self.stories[2]
+    old_title = self.edit(story, "As a User, I want to archive a user story, so that I clean up the backlog")
+    assert twin.defects.filter_by(subkind='identical').count() == 1
+    assert self.project.re_analyze([story.id], [old_title]) == [story.id, twin.id]
+    assert story.defects.filter_by(subkind='identical').count() == 0
+    assert twin.defects.filter_by(subkind='identical').count() == 0
+    assert twin.defects.count() > 0
+
+  def test_analyzed_story_records_its_hash(self):
+    story = Stories.create("As a User, I want to import stories, so that I save time", None, self.project.id, analyze=True)
+    assert story.analysis_hash == Stories.analysis_key(story.title, self.project.format)
+    assert story.id not in self.project.re_analyze()
+
+  def test_stories_sharing_the_new_title(self):
+    story, twin = self.stories[3], self.stories[0]
+    old_title = self.edit(story, twin.title)
+    assert self.project.re_analyze([story.id], [old_title]) == [twin.id, story.id]
+    assert story.defects.filter_by(subkind='identical').count() == 1
+    assert twin.defects.filter_by(subkind='identical').count() == 1
+
+  def test_format_flip(self):
+    edited, old_titles = [], []
+    for story in [self.stories[0], self.stories[1], self.stories[3]]:
+      old_titles.append(self.edit(story, story.title.replace("I want to", "I wish to")))
+      edited.append(story.id)
+    assert self.project.re_analyze(edited, old_titles) == [story.id for story in self.stories]
+    assert "I wish to" in self.project.format
+
+  def test_new_stories_are_chunked(self):
+    Stories.bulk_create(["As a User, I want to import stories, so that I save time"], self.project.id)
+    db.session.commit()
+    story = Stories.query.filter_by(project_id=self.project.id).order_by(Stories.id.desc()).first()
+    assert self.project.re_analyze() == [story.id]
+    assert story.role.strip() == "As a User,"
+
+class ParallelAnalyzerTests(TestCase):
+  TITLES = [
+    "As a User, I want to add a user story, so that I document a requirement (for money)",
+    "As a User, I want to delete a user story, so that I clean up the backlog",
+    "As a User, I want to delete a user story, so that I clean up the backlog",
+    "As a User, I want to export a report and print it, so that I share the results",
+    "I want to import stories, so that I save time",
+    "As a User, I wish to search stories. So that I find them"]
+
+  def analyzed_defects(self, processes):
+    project = new_project()
+    for title in self.TITLES:
+      Stories.create(title, None, project.id)
+    project.analyze(processes=processes)
+    stories = project.stories.order_by(Stories.id).all()
+    defects = sorted((story.title, defect.kind, defect.subkind, defect.severity, defect.highlight)
+      for story in stories for defect in story.defects)
+    return project.format, [story.analysis_hash for story in stories], defects
+
+  def test_same_defects_as_serial(self):
+    window = app.config['ANALYSIS_WINDOW']
+    app.config['ANALYSIS_WINDOW'] = 2
+    try:
+      serial, parallel = self.analyzed_defects(1), self.analyzed_defects(2)
+    finally:
+      app.config['ANALYSIS_WINDOW'] = window
+    assert serial[2]
+    assert parallel == serial
+
+class DuplicateStoriesTests(TestCase):
+  TITLE = "As a User, I want to add a user story, so that I document a requirement"
+
+  def setUp(self):
+    TestCase.setUp(self)
+    self.project = new_project()
+    self.triple = [Stories(title=self.TITLE, project_id=self.project.id).save() for _ in range(2)]
+    Stories.bulk_create([self.TITLE, "As a User, I want to export a report, so that I share the results"], self.project.id)
+    Stories.bulk_create([self.TITLE], new_project().id)
+    db.session.commit()
+    self.triple.append(Stories.query.filter_by(project_id=self.project.id, title=self.TITLE).order_by(Stories.id.desc()).first())
+    self.unique = Stories.query.filter_by(project_id=self.project.id).filter(Stories.title != self.TITLE).one()
+
+  # the rule as it was before duplicates were computed per project
+  def identical_per_story(self, story):
+    identical_stories = Stories.query.filter((Stories.title == story.title) & (Stories.project_id == int(story.project_id))).all()
+    identical_stories.remove(story)
+    return True if identical_stories else False
+
+  def assert_same_as_per_story_rule(self):
+    duplicates = Analyzer.duplicate_stories(self.project.id)
+    for story in self.project.stories.all():
+      expected = self.identical_per_story(story)
+      assert (story.id in duplicates) == expected
+      assert Analyzer.identical_rule(story) == expected
+      assert Analyzer.identical_rule(story, duplicates) == expected
+
+  def test_duplicate_group_and_unique_title(self):
+    assert Analyzer.duplicate_stories(self.project.id) == set(story.id for story in self.triple)
+    assert not Analyzer.identical_rule(self.unique)
+    self.assert_same_as_per_story_rule()
+
+  def test_limited_to_titles(self):
+    assert Analyzer.duplicate_stories(self.project.id, [self.unique.title]) == set()
+    assert Analyzer.duplicate_stories(self.project.id, [self.TITLE]) == set(story.id for story in self.triple)
+
+  def test_retitled_through_upsert(self):
+    Stories.bulk_create(["As a User, I want to import stories, so that I save time"], self.project.id, [7])
+    db.session.commit()
+    story_ids, changed, titles = self.project.upsert_stories([{'external_id': 7, 'title': self.unique.title}])
+    assert Analyzer.duplicate_stories(self.project.id) == set(story.id for story in self.triple) | set([self.unique.id] + story_ids)
+    self.assert_same_as_per_story_rule()
+
+  def test_retitled_through_the_session(self):
+    self.triple[0].title = "As a User, I want to import stories, so that I save time"
+    self.triple[0].save()
+    assert Analyzer.duplicate_stories(self.project.id) == set(story.id for story in self.triple[1:])
+    self.assert_same_as_per_story_rule()
+
+class ReportSummaryTests(TestCase):
+  def setUp(self):
+    TestCase.setUp(self)
+    self.project = new_project()
+    Stories.create("As a User, I want to add a user story, so that I document a requirement (for money)", 1, self.project.id)
+    Stories.create("As a User, I want to export a report, so that I share the results", 2, self.project.id)
+
+  def stored(self):
+    return ReportSummaries.query.get(self.project.id)
+
+  def assert_current(self):
+    summary = self.project.report_summary()
+    assert summary == self.project.report_counts()
+    version = db.session.query(Projects.report_version).filter_by(id=self.project.id).scalar()
+    assert self.stored().version == version
+    return summary
+
+  def test_stored_until_invalidated(self):
+    summary = self.assert_current()
+    assert summary['stories'] == 2
+    assert self.project.report_summary() == summary
+    db.session.commit()
+    assert self.stored().counts() == summary
+
+  def test_recounted_after_analysis(self):
+    assert self.assert_current()['total'] == 0
+    self.project.analyze()
+    summary = self.assert_current()
+    assert summary['total'] > 0
+    assert summary['minor'] + summary['medium'] + summary['high'] == summary['total']
+
+  def test_recounted_after_false_positive(self):
+    self.project.analyze()
+    before = self.assert_current()
+    defect = self.project.defects.first()
+    defect.false_positive = True
+    defect.save()
+    after = self.assert_current()
+    assert after['false_positives'] == before['false_positives'] + 1
+    assert after['total'] == before['total'] - 1
+
+  def test_recounted_after_delete_stories(self):
+    self.project.analyze()
+    self.assert_current()
+    self.project.delete_stories()
+    assert self.assert_current() == dict((key, 0) for key in REPORT_COUNTS)
+
+  def test_recounted_after_bulk_writes(self):
+    self.assert_current()
+    Stories.bulk_create(["As a User, I want to import stories, so that I save time"], self.project.id, [3])
+    db.session.commit()
+    assert self.assert_current()['stories'] == 3
+    version = self.stored().version
+    self.project.upsert_stories([{'external_id': 3, 'title': "As a User, I want to import files, so that I save time"}])
+    self.assert_current()
+    assert self.stored().version > version
+
+  def test_version_bumped_once_per_transaction(self):
+    self.assert_current()
+    version = self.stored().version
+    for story in self.project.stories:
+      story.title = story.title + " quickly"
+      db.session.flush()
+    assert self.project.report_summary() == self.project.report_counts()
+    db.session.commit()
+    assert db.session.query(Projects.report_version).filter_by(id=self.project.id).scalar() == version + 1
+    self.assert_current()
+
+class JobsTests(TestCase):
+  def test_stored_jobs_serialize_as_in_memory(self):
+    jobs = JobQueue(workers=1, store=Jobs.store)
+    def run(job):
+      job.progress('analyze', 2, 2)
+      return [{'id': 1, 'defects': []}]
+    job = jobs.submit('run', run)
+    jobs.close()
+    assert Jobs.query.get(job.id).serialize() == job.serialize()
+
+  def test_failed_job_is_stored(self):
+    jobs = JobQueue(workers=1, store=Jobs.store)
+    job = jobs.submit('fail', lambda job: 1 / 0)
+    jobs.close()
+    stored = Jobs.query.get(job.id)
+    assert stored.status == 'failed'
+    assert stored.error.startswith('ZeroDivisionError')
+
+class UniformVerdictsTests(unittest.TestCase):
+  FORMAT = "As a, I want to, So that"
+  STORIES = [
+    ("As a User,", "I want to add a user story,", "so that I document a requirement"),
+    ("As an Admin,", "I wish to remove users,", "so I keep the list clean"),
+    ("As a User,", "I am able to add a user story,", "in order to document it"),
+    ("As a User,", "I'm able to add a user story,", None),
+    ("As a User,", None, None),
+    (None, "I want to add a user story", None),
+    (None, None, None)]
+
+  # the uniform rule as it was, with an edit distance per story chunk
+  def uniform_per_story(self, story, project_format):
+    from nltk.metrics.distance import edit_distance
+    project_format = project_format.split(',')
+    chunks = [Analyzer.extract_indicator_phrases(getattr(story, chunk), chunk) for chunk in CHUNKS]
+    chunks = [chunk.strip() for chunk in filter(None, chunks)]
+    result = len(chunks) == 1
+    for x in range(0, len(chunks)):
+      if edit_distance(chunks[x].lower(), project_format[x].lower()) > 3:
+        result = True
+    return result
+
+  def test_same_verdicts_as_per_story_rule(self):
+    verdicts = UniformVerdicts(self.FORMAT)
+    for role, means, ends in self.STORIES * 2:
+      story = types.SimpleNamespace(role=role, means=means, ends=ends)
+      assert Analyzer.uniform_rule(story, verdicts) == self.uniform_per_story(story, self.FORMAT)
+
+  def test_single_chunk_deviates(self):
+    story = types.SimpleNamespace(role="As a User,", means=None, ends=None)
+    assert Analyzer.uniform_rule(story, UniformVerdicts(self.FORMAT))
+
+  def test_deviates(self):
+    verdicts = UniformVerdicts(self.FORMAT)
+    assert not verdicts.deviates(1, "I want to")
+    assert not verdicts.deviates(1, "I WANT TO")
+    assert verdicts.deviates(1, "I am able to")
+    assert not verdicts.deviates(2, "So that")
+    assert verdicts.deviates(2, "So")
+    assert verdicts.deviates(2, "In order to")
+    assert verdicts.verdicts[(1, "i want to")] is False
+
+class RuleTests(unittest.TestCase):
+  def rule(self, kind='minimal', inputs=(), enabled=True):
+    return Rule(kind, 'test', 'minor', lambda story, **inputs: True, lambda story, **inputs: '', inputs, enabled)
+
+  def test_input_sets(self):
+    context = {'duplicates': set([1]), 'uniform_verdicts': None}
+    assert self.rule().input_sets(context) == [{}]
+    assert self.rule(inputs=['duplicates']).input_sets(context) == [{'duplicates': set([1])}]
+    assert self.rule(inputs=['duplicates']).input_sets({}) == [{'duplicates': None}]
+
+  def test_chunk_input_sets(self):
+    sets = self.rule(inputs=['chunk', 'duplicates']).input_sets({'duplicates': set()})
+    assert sets == [{'chunk': chunk, 'duplicates': set()} for chunk in CHUNKS]
+
+  def test_registry_skips_disabled_rules(self):
+    rules = RuleRegistry()
+    enabled = rules.add(self.rule('atomic'))
+    rules.add(self.rule('atomic', enabled=False))
+    assert list(rules) == [enabled]
+    assert rules.kind('atomic') == [enabled]
+    assert rules.kind('unique') == []
+
+  def test_register(self):
+    rules = RuleRegistry()
+    @rules.register('minimal', 'too_long', 'minor', lambda story: 'Shorten the story')
+    def too_long(story):
+      return len(story.title) > 10
+    rule, = list(rules)
+    assert (rule.kind, rule.subkind, rule.severity, rule.check) == ('minimal', 'too_long', 'minor', too_long)
+
+  def test_kinds_keep_the_analysis_order(self):
+    rules = RuleRegistry()
+    for kind in ['custom', 'uniform', 'atomic', 'other']:
+      rules.add(self.rule(kind))
+    assert rules.kinds(ANALYSIS_ORDER) == ANALYSIS_ORDER + ['custom', 'other']
+    assert RULES.kinds(ANALYSIS_ORDER) == ['well_formed', 'atomic', 'unique', 'minimal', 'uniform']
+
+  def test_builtin_rules(self):
+    assert [(rule.kind, rule.subkind) for rule in RULES] == [('well_formed', 'no_means'), ('well_formed', 'no_role'),
+      ('minimal', 'punctuation'), ('minimal', 'brackets'), ('minimal', 'indicator_repetition'),
+      ('atomic', 'conjunctions'), ('unique', 'identical'), ('uniform', 'uniform')]
+
+  def test_well_formed_and_minimal_checks(self):
+    story = types.SimpleNamespace(title="As a User, I want to add a story (for now). So that I can add more", role=None, means="I want to add a story")
+    rule = dict((rule.subkind, rule) for rule in RULES)
+    assert rule['no_role'].check(story) and not rule['no_means'].check(story)
+    assert rule['punctuation'].check(story) and rule['brackets'].check(story)
+    assert [inputs['chunk'] for inputs in rule['indicator_repetition'].input_sets({})
+      if rule['indicator_repetition'].check(story, **inputs)] == []
+    story.title = "As a User, I want to add a story, I want to remove it"
+    assert not rule['punctuation'].check(story) and not rule['brackets'].check(story)
+    assert [inputs['chunk'] for inputs in rule['indicator_repetition'].input_sets({})
+      if rule['indicator_repetition'].check(story, **inputs)] == ['means']
+
+
+def new_project():
+  return Projects(name="Test Project").save()
 
 def create_project():
   p = Project.create(name="Test Project")
@@ -0,0 +1,54 @@
+import random
+import unittest
+
+import nltk
+
+from app.chunker import ChunkGrammar
+
+GRAMMAR = """
+      NP: {<DT|JJ|NN.*>}
+      NNP: {<NNP.*>}
+      AP: {<RB.*|JJ.*>}
+      VP: {<VB.*><NP>*}
+      MEANS: {<AP>?<VP>}
+      ENDS: {<AP>?<VP>}
+    """
+TAGS = ['DT', 'JJ', 'JJR', 'JJS', 'NN', 'NNS', 'NNP', 'NNPS', 'RB', 'RBR', 'VB', 'VBD', 'VBG', 'VBZ',
+  'PRP', 'PRP$', 'IN', 'TO', 'CC', 'MD', ',', '.', ':', '-LRB-', 'VP', 'NP']
+
+def labels(tree):
+  return set(subtree.label() for subtree in tree.subtrees())
+
+class ChunkGrammarTests(unittest.TestCase):
+  def setUp(self):
+    self.chunker = ChunkGrammar(GRAMMAR)
+    self.parser = nltk.RegexpParser(GRAMMAR)
+
+  def assert_same(self, sentence):
+    expected = self.parser.parse(list(sentence))
+    assert self.chunker.parse(sentence) == expected, (sentence, expected)
+    assert self.chunker.labels(sentence) == labels(expected)
+
+  def test_means(self):
+    sentence = [('I', 'PRP'), ('quickly', 'RB'), ('add', 'VB'), ('a', 'DT'), ('new', 'JJ'), ('story', 'NN')]
+    self.assert_same(sentence)
+    assert 'MEANS' in self.chunker.labels(sentence)
+
+  def test_special_word_tagged_vp(self):
+    self.assert_same([('I', 'PRP'), ('import', 'VP'), ('the', 'DT'), ('file', 'NN')])
+
+  def test_no_chunks(self):
+    sentence = [('to', 'TO'), (',', ','), ('if', 'IN')]
+    self.assert_same(sentence)
+    assert self.chunker.labels(sentence) == set(['S'])
+
+  def test_unknown_tags_are_added(self):
+    self.assert_same([('x', 'NEWTAG'), ('run', 'VBX'), ('y', 'NNX')])
+
+  def test_matches_nltk_on_random_sentences(self):
+    generator = random.Random(7)
+    for index in range(2000):
+      self.assert_same([('w%d' % position, generator.choice(TAGS)) for position in range(generator.randint(1, 12))])
+
+  def test_bad_rule(self):
+    self.assertRaises(ValueError, ChunkGrammar, "NP: <DT>")
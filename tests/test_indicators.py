@@ -0,0 +1,32 @@
+import unittest
+
+from app.indicators import IndicatorEngine
+
+ENGINE = IndicatorEngine({'role': ["^As an ", "^As a ", "^As "],
+  'means': ["[, ]I want to ", "[, ]I can ", "[, ]I want "],
+  'ends': ["[, ]So that ", "[, ]So "]})
+
+class IndicatorEngineTests(unittest.TestCase):
+  def test_spans_include_overlapping_indicators(self):
+    spans = ENGINE.spans("As a User, I want to add a story, so that I can plan")
+    assert spans['role'] == [(0, 5), (0, 3)]
+    assert spans['means'] == [(10, 21), (41, 48), (10, 18)]
+    assert spans['ends'] == [(33, 42), (33, 37)]
+
+  def test_spans_of_one_indicator_do_not_overlap(self):
+    assert ENGINE.spans("As a user, so so I know")['ends'] == [(10, 14)]
+
+  def test_detect_returns_longest_phrase_per_kind(self):
+    title = "As a User, I want to add a story, so that I can plan"
+    detected = ENGINE.detect(title, title.replace(',', ' '))
+    assert detected['role'] == (True, 'As a')
+    assert detected['means'] == (True, 'I want to')
+    assert detected['ends'] == (True, 'So that')
+
+  def test_detect_requires_phrase_in_text(self):
+    assert ENGINE.detect("As a user, I want to", "As a user")['means'] == (False, '')
+
+  def test_extract_from_chunk(self):
+    assert ENGINE.extract("I want to add a story,", 'means') == 'I want to '
+    assert ENGINE.extract("add a story", 'means') is None
+    assert ENGINE.extract(None, 'means') is None
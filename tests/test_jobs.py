@@ -0,0 +1,77 @@
+import threading
+import unittest
+
+from app.jobs import JobQueue, wait_for
+
+class JobQueueTests(unittest.TestCase):
+  def setUp(self):
+    self.jobs = JobQueue(workers=1)
+
+  def tearDown(self):
+    self.jobs.close()
+
+  def test_submit_returns_before_job_runs(self):
+    release = threading.Event()
+    job = self.jobs.submit('wait', lambda job: release.wait(5))
+    assert job.status in ('queued', 'running')
+    assert self.jobs.get(job.id) is job
+    release.set()
+    self.jobs.close()
+    assert job.status == 'done'
+    assert job.finished_at is not None
+
+  def test_progress_and_result(self):
+    def run(job):
+      job.progress('analyze', 3, 4)
+      return 'ok'
+    job = self.jobs.submit('run', run)
+    self.jobs.close()
+    assert job.result == 'ok'
+    assert job.serialize()['stage'] == 'analyze'
+    assert job.serialize()['result'] == 'ok'
+    assert (job.done, job.total) == (3, 4)
+
+  def test_failed_job_records_error(self):
+    job = self.jobs.submit('fail', lambda job: 1 / 0)
+    self.jobs.close()
+    assert job.status == 'failed'
+    assert job.error.startswith('ZeroDivisionError')
+
+  def test_only_recent_finished_jobs_are_kept(self):
+    jobs = JobQueue(workers=1, keep=2)
+    submitted = [jobs.submit(name, lambda job: None) for name in ('first', 'second')]
+    wait_for(lambda: True if all(job.finished for job in submitted) else None, timeout=5, interval=0.01)
+    jobs.submit('third', lambda job: None)
+    jobs.close()
+    assert jobs.get(submitted[0].id) is None
+    assert jobs.get(submitted[1].id) is submitted[1]
+
+  def test_store_sees_every_change(self):
+    states = []
+    jobs = JobQueue(workers=1, store=lambda job: states.append((job.status, job.stage, job.done)))
+    def run(job):
+      job.progress('analyze', 1, 2)
+      return 'ok'
+    jobs.submit('run', run)
+    jobs.close()
+    assert states == [('queued', None, 0), ('running', None, 0), ('running', 'analyze', 1), ('done', 'analyze', 1)]
+
+  def test_failing_store_does_not_fail_the_job(self):
+    def store(job):
+      raise IOError('database is down')
+    jobs = JobQueue(workers=1, store=store)
+    job = jobs.submit('run', lambda job: 'ok')
+    jobs.close()
+    assert (job.status, job.result) == ('done', 'ok')
+
+class WaitForTests(unittest.TestCase):
+  def test_retries_until_found(self):
+    attempts = []
+    def lookup():
+      attempts.append(1)
+      return 'project' if len(attempts) == 3 else None
+    assert wait_for(lookup, timeout=1, interval=0) == 'project'
+    assert len(attempts) == 3
+
+  def test_times_out(self):
+    self.assertRaises(LookupError, wait_for, lambda: None, timeout=0, interval=0)
@@ -0,0 +1,54 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from nltk.corpus.reader.wordnet import WordNetCorpusReader
+
+from app.lexicon import Lexicon, POS_LIST
+
+LEMMAS = {'dog': 'nv', 'goose': 'n', 'run': 'nv', 'big': 'a', 'large': 'a', 'quickly': 'r', 'box': 'nv',
+  'church': 'n', 'wife': 'n', 'man': 'n', 'fly': 'nv', 'use': 'nv', 'save': 'v', 'user': 'n', "o'clock": 'r', 'ice_cream': 'n'}
+EXCEPTIONS = {'n': {'geese': ['goose'], 'men': ['man']}, 'v': {'ran': ['run'], 'flew': ['fly']}, 'a': {'bigger': ['big']}}
+
+# nltk's synsets() lookup, over the same lemmas and exceptions
+class WordNetStub(object):
+  MORPHOLOGICAL_SUBSTITUTIONS = WordNetCorpusReader.MORPHOLOGICAL_SUBSTITUTIONS
+  _morphy = WordNetCorpusReader._morphy
+
+  def __init__(self):
+    self._lemma_pos_offset_map = dict((lemma, dict((pos, [1]) for pos in parts)) for lemma, parts in LEMMAS.items())
+    self._exception_map = dict((pos, EXCEPTIONS.get(pos, {})) for pos in POS_LIST)
+
+  def is_known_word(self, word):
+    return any(self._morphy(word.lower(), pos) for pos in POS_LIST)
+
+class LexiconTests(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.lexicon = Lexicon(Lexicon.build(os.path.join(self.directory, 'lexicon.tsv'), LEMMAS, EXCEPTIONS))
+
+  def tearDown(self):
+    self.lexicon.data.close()
+    shutil.rmtree(self.directory)
+
+  def test_known_words(self):
+    for word in ['dog', 'Dogs', 'geese', 'men', 'ran', 'using', 'boxes', 'churches', 'flies', 'bigger', 'larger', 'quickly', 'saved', 'users']:
+      assert self.lexicon.is_known_word(word), word
+
+  def test_unknown_words(self):
+    for word in ['admin', 'CRUD', 'quicklies', 'geeses', 'zzz', '']:
+      assert not self.lexicon.is_known_word(word), word
+
+  def test_matches_wordnet_lookup(self):
+    wordnet = WordNetStub()
+    words = list(LEMMAS) + [word for exceptions in EXCEPTIONS.values() for word in exceptions]
+    suffixes = ['', 's', 'es', 'ies', 'ed', 'ing', 'er', 'est', 'men', 'ves', 'x']
+    generator = random.Random(3)
+    for index in range(3000):
+      word = generator.choice(words)[:generator.randint(1, 8)] + generator.choice(suffixes)
+      assert self.lexicon.is_known_word(word) == wordnet.is_known_word(word), word
+
+  def test_open_missing_lexicon(self):
+    assert Lexicon.open(os.path.join(self.directory, 'missing.tsv')) is None
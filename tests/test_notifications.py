@@ -0,0 +1,91 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import threading
+import unittest
+
+from app.notifications import Notifier
+
+class StubServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+# answers GETs with the next status of the path's script, 200 once it runs out
+class StubHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    with self.server.lock:
+      self.server.requests.append(self.path)
+      statuses = self.server.statuses.get(self.path, [])
+      status = statuses.pop(0) if statuses else 200
+    if self.server.release is not None:
+      self.server.release.wait(5)
+    self.send_response(status)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+class NotifierTests(unittest.TestCase):
+  def setUp(self):
+    self.server = StubServer(('127.0.0.1', 0), StubHandler)
+    self.server.lock = threading.Lock()
+    self.server.requests = []
+    self.server.statuses = {}
+    self.server.release = None
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.notifier = Notifier(workers=2, retries=2, backoff=0.01, timeout=2)
+
+  def tearDown(self):
+    self.notifier.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def url(self, path):
+    return 'http://127.0.0.1:%s%s' % (self.server.server_address[1], path)
+
+  def test_delivers_in_background(self):
+    future = self.notifier.notify(self.url('/defects/1/create_comments'))
+    assert future.result(5) == 200
+    assert self.server.requests == ['/defects/1/create_comments']
+
+  def test_retries_server_errors(self):
+    self.server.statuses['/flaky'] = [500, 503]
+    assert self.notifier.notify(self.url('/flaky')).result(5) == 200
+    assert self.server.requests == ['/flaky'] * 3
+
+  def test_gives_up_after_retries(self):
+    self.server.statuses['/down'] = [500] * 10
+    assert self.notifier.notify(self.url('/down')).result(5) is None
+    assert len(self.server.requests) == 3
+
+  def test_does_not_retry_client_errors(self):
+    self.server.statuses['/gone'] = [404]
+    assert self.notifier.notify(self.url('/gone')).result(5) == 404
+    assert len(self.server.requests) == 1
+
+  def test_coalesces_within_a_run(self):
+    with self.notifier.coalesce():
+      with self.notifier.coalesce():
+        assert self.notifier.notify(self.url('/a')) is None
+      self.notifier.notify(self.url('/b'))
+      self.notifier.notify(self.url('/a'))
+      assert self.server.requests == []
+    self.notifier.close()
+    assert sorted(self.server.requests) == ['/a', '/b']
+
+  def test_concurrency_is_bounded(self):
+    self.server.release = threading.Event()
+    futures = [self.notifier.notify(self.url('/slow/%s' % index)) for index in range(4)]
+    for _ in range(100):
+      if len(self.server.requests) == 2: break
+      threading.Event().wait(0.01)
+    threading.Event().wait(0.05)
+    assert len(self.server.requests) == 2
+    self.server.release.set()
+    assert [future.result(5) for future in futures] == [200] * 4
+
+  def test_unreachable_receiver(self):
+    self.server.shutdown()
+    self.server.server_close()
+    notifier = Notifier(workers=1, retries=1, backoff=0.01, timeout=0.5)
+    assert notifier.notify(self.url('/nobody')).result(5) is None
+    notifier.close()
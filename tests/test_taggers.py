@@ -0,0 +1,216 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from app.taggers import StanfordTagger, BatchingTagger, TaggerPool, TagCache, CachingTagger, TaggingPlan
+
+FAKE_TAGGER = '%s %s' % (sys.executable, os.path.join(os.path.dirname(__file__), 'fake_tagger.py'))
+
+class StanfordTaggerTests(unittest.TestCase):
+  def setUp(self):
+    self.tagger = StanfordTagger(cmd=FAKE_TAGGER)
+
+  def tearDown(self):
+    self.tagger.close()
+
+  def test_parse(self):
+    assert self.tagger.parse("As a/DT user") == [[('As', 'NN'), ('a', 'DT'), ('user', 'NN')]]
+
+  def test_parse_batch_is_aligned(self):
+    result = self.tagger.parse_batch(["I want/VBP", "", "so  that\nI know/VBP"])
+    assert result[0] == [[('I', 'NN'), ('want', 'VBP')]]
+    assert result[1] == [[]]
+    assert result[2] == [[('so', 'NN'), ('that', 'NN'), ('I', 'NN'), ('know', 'VBP')]]
+
+  def test_consecutive_calls(self):
+    for word in ['user', 'admin', 'visitor']:
+      assert self.tagger.parse(word) == [[(word, 'NN')]]
+
+  def test_exited_tagger(self):
+    result = self.tagger.parse_batch(["EXIT", "user"])
+    assert all('error' in response for response in result)
+
+class TaggerPoolTests(unittest.TestCase):
+  def setUp(self):
+    self.pool = TaggerPool(2, factory=lambda: StanfordTagger(cmd=FAKE_TAGGER))
+
+  def tearDown(self):
+    self.pool.close()
+
+  def test_checkout_hands_out_distinct_taggers(self):
+    with self.pool.checkout() as first:
+      with self.pool.checkout() as second:
+        assert first is not second
+
+  def test_exited_tagger_is_restarted(self):
+    with self.pool.checkout() as tagger:
+      assert 'error' in tagger.parse("EXIT")
+      assert not tagger.healthy
+    with self.pool.checkout() as first:
+      with self.pool.checkout() as second:
+        assert first.healthy and second.healthy
+        assert tagger not in [first, second]
+
+  def test_parse_batch_keeps_order_across_taggers(self):
+    texts = ['story%d' % index for index in range(120)]
+    assert self.pool.parse_batch(texts) == [[[(text, 'NN')]] for text in texts]
+
+  def test_taggers_start_on_first_use(self):
+    assert self.pool.started == 0
+    assert self.pool.parse("user") == [[('user', 'NN')]]
+    assert self.pool.started == 1
+    assert not self.pool.ready.is_set()
+
+  def test_waiting_checkout_starts_a_tagger_after_a_failed_start(self):
+    starting, attempts = threading.Event(), []
+    def factory():
+      attempts.append(1)
+      if len(attempts) == 1:
+        starting.set()
+        threading.Event().wait(0.2)
+        raise OSError('tagger did not start')
+      return StanfordTagger(cmd=FAKE_TAGGER)
+    pool = TaggerPool(1, factory=factory)
+    failed = []
+    def first():
+      try:
+        with pool.checkout(): pass
+      except OSError as error:
+        failed.append(error)
+    thread = threading.Thread(target=first)
+    thread.start()
+    assert starting.wait(5)
+    with pool.checkout() as tagger:
+      assert tagger.parse("user") == [[('user', 'NN')]]
+    thread.join(5)
+    assert len(failed) == 1 and len(attempts) == 2
+    pool.close()
+
+  def test_failed_start_raises(self):
+    def factory():
+      raise OSError('tagger did not start')
+    pool = TaggerPool(1, factory=factory)
+    with self.assertRaises(OSError):
+      with pool.checkout(): pass
+    assert pool.started == 0
+
+  def test_prefork_starts_every_tagger(self):
+    pool = TaggerPool(2, factory=lambda: StanfordTagger(cmd=FAKE_TAGGER), prefork=True)
+    assert pool.wait_ready(10)
+    assert pool.started == 2 and pool.idle.qsize() == 2
+    pool.close()
+
+class TagCacheTests(unittest.TestCase):
+  def test_lru_eviction_and_counters(self):
+    cache = TagCache(size=2)
+    cache.put('a', [[('a', 'DT')]])
+    cache.put('b', [[('b', 'NN')]])
+    cache.get('a')
+    cache.put('c', [[('c', 'NN')]])
+    assert cache.get('b') is None
+    assert cache.get('a') == [[('a', 'DT')]]
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'size': 2}
+
+  def test_persistent_store(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'tags.sqlite')
+      TagCache(path=path).put('user', [[('user', 'NN')]])
+      assert TagCache(path=path).get('user') == [[('user', 'NN')]]
+      assert TagCache(path=path, model='other.tagger').get('user') is None
+
+  def test_only_misses_reach_the_tagger(self):
+    tagger = CachingTagger(StanfordTagger(cmd=FAKE_TAGGER), TagCache())
+    tagger.parse_batch(['user', 'admin'])
+    tagger.tagger.close()
+    assert tagger.parse_batch(['admin', 'user', 'admin']) == [[[('admin', 'NN')]], [[('user', 'NN')]], [[('admin', 'NN')]]]
+    assert tagger.cache.stats()['hits'] == 3
+
+class BatchingTaggerTests(unittest.TestCase):
+  def setUp(self):
+    self.tagger = BatchingTagger(StanfordTagger(cmd=FAKE_TAGGER))
+
+  def tearDown(self):
+    self.tagger.tagger.close()
+
+  def test_batch_serves_prefetched_texts(self):
+    with self.tagger.batch(["user", "admin", None]):
+      assert set(self.tagger.tagged) == set(["user", "admin"])
+      assert self.tagger.parse("admin") == [[('admin', 'NN')]]
+    assert self.tagger.tagged == {}
+
+  def test_plan_serves_chunks_of_the_title(self):
+    title = "As a user, I want to add a story"
+    with self.tagger.plan([title]):
+      assert self.tagger.parse("I want to add a story", title) == [[('I', 'NN'), ('want', 'NN'), ('to', 'NN'), ('add', 'NN'), ('a', 'NN'), ('story', 'NN')]]
+      with self.tagger.batch(["As a user,", "a user, I"], [title, title]):
+        assert self.tagger.tagged == {}
+    assert self.tagger.plans == {}
+
+  def test_texts_outside_the_plan_are_tagged(self):
+    title = "As a user, I want to add a story"
+    with self.tagger.plan([title]):
+      with self.tagger.batch(["add a stor", "As an admin"], [title, title]):
+        assert set(self.tagger.tagged) == set(["add a stor", "As an admin"])
+
+  def test_plans_are_kept_per_thread(self):
+    title = "As a user, I want to add a story"
+    recorder = self.tagger.tagger = RecordingTagger(self.tagger.tagger)
+    first_planned, second_planned, results = threading.Event(), threading.Event(), []
+    def first():
+      with self.tagger.plan([title]):
+        first_planned.set()
+        second_planned.wait(5)
+    def second():
+      first_planned.wait(5)
+      with self.tagger.plan([title]):
+        second_planned.set()
+        threads[0].join(5)
+        results.append(self.tagger.parse("I want to add a story", title))
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(5)
+    assert results == [[[('I', 'NN'), ('want', 'NN'), ('to', 'NN'), ('add', 'NN'), ('a', 'NN'), ('story', 'NN')]]]
+    assert recorder.batches == [[title], [title]]
+    assert recorder.parsed == []
+
+# passes tagging on, recording what is tagged one text at a time
+class RecordingTagger(object):
+  def __init__(self, tagger):
+    self.tagger = tagger
+    self.parsed = []
+    self.batches = []
+
+  def parse(self, text):
+    self.parsed.append(text)
+    return self.tagger.parse(text)
+
+  def parse_batch(self, texts):
+    self.batches.append(list(texts))
+    return self.tagger.parse_batch(texts)
+
+  def close(self):
+    self.tagger.close()
+
+class TaggingPlanTests(unittest.TestCase):
+  def test_slices_whole_tokens(self):
+    plan = TaggingPlan("As a user, I want (a) story.", [[('As', 'IN'), ('a', 'DT'), ('user', 'NN'), (',', ','),
+      ('I', 'PRP'), ('want', 'VBP'), ('-LRB-', '-LRB-'), ('a', 'DT'), ('-RRB-', '-RRB-'), ('story', 'NN'), ('.', '.')]])
+    assert plan.aligned
+    assert plan.slice(" a user, ") == [[('a', 'DT'), ('user', 'NN'), (',', ',')]]
+    assert plan.slice("(a) story") == [[('-LRB-', '-LRB-'), ('a', 'DT'), ('-RRB-', '-RRB-'), ('story', 'NN')]]
+    assert plan.slice("use") is None
+    assert plan.slice("an admin") is None
+
+  def test_keeps_sentences_apart(self):
+    plan = TaggingPlan("Log in. Then pay", [[('Log', 'VB'), ('in', 'RP'), ('.', '.')], [('Then', 'RB'), ('pay', 'VB')]])
+    assert plan.slice("in. Then") == [[('in', 'RP'), ('.', '.')], [('Then', 'RB')]]
+
+  def test_unaligned_tagging_is_not_used(self):
+    plan = TaggingPlan("user_id is set", [[('userid', 'NN'), ('is', 'VBZ'), ('set', 'VBN')]])
+    assert not plan.aligned
+    assert plan.slice("is set") is None
+    assert not TaggingPlan("user", {'error': 'timed out'}).aligned